@@ -18,10 +18,50 @@
 Helper functions for building geometries for various OSM types.
 """
 
+import numpy as np
+import shapely
 import sqlalchemy as sa
 from shapely.geometry import LineString, MultiLineString
+from geoalchemy2.elements import WKBElement
 from geoalchemy2.shape import to_shape
 
+EARTH_RADIUS = 6378137.0
+MERCATOR_MAX_LAT = 85.0511287798066
+
+def project_to_mercator(coords):
+    """ Project a NumPy array of shape (n, 2) with WGS84 coordinates
+        to Web Mercator. Latitudes beyond the bounds of the projection
+        are clipped.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    out = np.empty_like(coords)
+    out[:, 0] = np.radians(coords[:, 0]) * EARTH_RADIUS
+    lat = np.radians(np.clip(coords[:, 1], -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT))
+    out[:, 1] = np.log(np.tan(np.pi / 4 + lat / 2)) * EARTH_RADIUS
+
+    return out
+
+def build_linestrings(coord_list, srid):
+    """ Create line strings for a list of coordinate arrays of shape (n, 2)
+        in one go. Returns a list with a WKBElement (as EWKB with the
+        given SRID) for each array or None if the array has less than
+        two points.
+    """
+    result = [None] * len(coord_list)
+    valid = [i for i, c in enumerate(coord_list) if len(c) > 1]
+    if not valid:
+        return result
+
+    geoms = shapely.linestrings(
+                np.concatenate([coord_list[i] for i in valid]),
+                indices=np.repeat(np.arange(len(valid)),
+                                  [len(coord_list[i]) for i in valid]))
+    wkbs = shapely.to_wkb(shapely.set_srid(geoms, srid), include_srid=True)
+    for i, wkb in zip(valid, wkbs):
+        result[i] = WKBElement(wkb, srid=srid, extended=True)
+
+    return result
+
 def _sqr_dist(pt1, pt2):
     """ Returns the squared simple distance of two points.
         As we only compare close distances, we neither care about curvature
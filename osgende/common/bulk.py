@@ -0,0 +1,179 @@
+# SPDX-License-Identifier: GPL-3.0-only
+#
+# This file is part of Osgende
+# Copyright (C) 2024 Sarah Hoffmann
+"""
+Buffered bulk writing of rows into database tables.
+"""
+
+import struct
+
+import numpy as np
+import psycopg
+from psycopg import sql as pgsql
+from psycopg.adapt import Dumper
+from psycopg.pq import Format
+from geoalchemy2 import Geometry
+from geoalchemy2.elements import WKBElement
+
+class _EWKBBinaryDumper(Dumper):
+    """ Passes raw (E)WKB bytes on as binary PostGIS geometry.
+
+        The oid of the geometry type differs between databases. The
+        writer creates a subclass with the right oid on the fly.
+    """
+    format = Format.BINARY
+
+    def dump(self, obj):
+        return obj
+
+
+def to_ewkb(value):
+    """ Convert a geometry value into EWKB bytes as expected by the
+        binary input function of PostGIS. `value` may be a WKBElement
+        or raw EWKB bytes.
+    """
+    if isinstance(value, WKBElement):
+        if not value.extended:
+            value = value.as_ewkb()
+        return bytes(value.data)
+
+    return value
+
+
+def linestring_ewkb(coords, srid):
+    """ Return a WKBElement with a line string in EWKB format built
+        directly from a NumPy array of shape (n, 2) with coordinates.
+    """
+    # PostGIS extension that includes a SRID, see postgis/doc/ZMSGeoms.txt
+    data = struct.pack('<bIII', 1, 0x20000002, srid, len(coords))\
+           + np.ascontiguousarray(coords, dtype='<f8').tobytes()
+    return WKBElement(data, srid=srid, extended=True)
+
+
+def table_identifier(table):
+    """ Return the psycopg identifier for the given SQLAlchemy table.
+    """
+    if table.schema:
+        return pgsql.Identifier(table.schema, table.name)
+
+    return pgsql.Identifier(table.name)
+
+
+def _get_column_types(conn, tablename):
+    """ Return a dictionary of column name to (oid, type name) for
+        the table with the given (quoted) name.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""SELECT attname, atttypid, typname
+                         FROM pg_attribute a, pg_type t
+                        WHERE a.atttypid = t.oid
+                              and attrelid = %s::regclass
+                              and attnum > 0 and not attisdropped""",
+                    (tablename, ))
+        return {r[0]: (r[1], r[2]) for r in cur}
+
+
+def binary_copy_types(dbapi_conn, tablename, columns):
+    """ Prepare the psycopg connection `dbapi_conn` for a binary COPY into
+        the given columns of the table with the given (quoted) name.
+        Returns the list of type oids to hand to Copy.set_types().
+        Geometry columns expect raw EWKB bytes.
+    """
+    coltypes = _get_column_types(dbapi_conn, tablename)
+
+    oids = []
+    for col in columns:
+        oid, typname = coltypes[col]
+        oids.append(oid)
+        if typname == 'geometry':
+            dumper = type('GeometryBinaryDumper', (_EWKBBinaryDumper, ),
+                          {'oid': oid})
+            dbapi_conn.adapters.register_dumper(None, dumper)
+
+    return oids
+
+
+class BulkInserter:
+    """ Buffers rows for the SQLAlchemy table `table` and writes them out
+        in batches of `batch_size` rows using the SQLAlchemy connection
+        `conn`. Rows must be dictionaries of column name to value. Rows
+        may leave out columns, these are set to NULL. Keys that are not
+        columns of the table are rejected with a ValueError.
+
+        When the connection is backed by psycopg, the rows are sent with
+        a binary COPY. Geometries are then transferred as EWKB without
+        any intermediate text encoding. For any other driver, the writer
+        falls back to multi-row INSERT statements.
+
+        The writer takes part in the current transaction of `conn`. Make
+        sure to call flush() before committing.
+    """
+
+    def __init__(self, conn, table, batch_size=1000):
+        self.conn = conn
+        self.table = table
+        self.batch_size = max(1, batch_size or 1)
+        self.rows = []
+        self.columns = None
+        self.oids = None
+        self.converters = None
+        self.known_columns = frozenset(c.name for c in table.c)
+
+        dbapi_conn = conn.connection.dbapi_connection
+        self.use_copy = isinstance(dbapi_conn, psycopg.Connection)
+
+    def add(self, row):
+        """ Add a new row. The buffer is flushed when it is full.
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Write out all currently buffered rows.
+        """
+        if not self.rows:
+            return
+
+        keys = set()
+        for row in self.rows:
+            keys.update(row.keys())
+        if not keys <= self.known_columns:
+            raise ValueError(f"Unknown columns for table '{self.table.name}': "
+                             f"{', '.join(sorted(keys - self.known_columns))}")
+        columns = [c.name for c in self.table.c if c.name in keys]
+
+        if self.use_copy:
+            self._write_copy(columns)
+        else:
+            self.conn.execute(self.table.insert().values(
+                                [{c: row.get(c) for c in columns} for row in self.rows]))
+
+        self.rows = []
+
+    def _write_copy(self, columns):
+        dbapi_conn = self.conn.connection.dbapi_connection
+
+        if self.columns != columns:
+            self._setup_copy(dbapi_conn, columns)
+
+        sql = pgsql.SQL("COPY {} ({}) FROM STDIN (FORMAT BINARY)").format(
+                  table_identifier(self.table),
+                  pgsql.SQL(',').join(map(pgsql.Identifier, self.columns)))
+
+        with dbapi_conn.cursor() as cur:
+            with cur.copy(sql) as copy:
+                copy.set_types(self.oids)
+                for row in self.rows:
+                    copy.write_row([conv(row.get(c)) if conv else row.get(c)
+                                    for c, conv in zip(self.columns, self.converters)])
+
+    def _setup_copy(self, dbapi_conn, columns):
+        self.columns = columns
+
+        self.oids = binary_copy_types(
+                        dbapi_conn, table_identifier(self.table).as_string(dbapi_conn),
+                        self.columns)
+        self.converters = [to_ewkb if isinstance(c.type, Geometry) else None
+                           for c in self.table.c if c.name in self.columns]
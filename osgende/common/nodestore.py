@@ -19,15 +19,21 @@ File-backed storage for node geometries.
 """
 
 import logging
+import os
 from binascii import hexlify
 from struct import pack
 from collections import namedtuple
 
+import numpy as np
 from osmium import index, osm, NodeLocationsForWays
 from osmium.geom import lonlat_to_mercator, Coordinates
 
 LOG = logging.getLogger(__name__)
 
+# Fixed-point representation of locations in osmium.
+COORDINATE_PRECISION = 10000000
+UNDEFINED_COORDINATE = 2147483647
+
 class NodeStorePoint(namedtuple('NodeStorePoint', ['x', 'y'])):
     """ A single entry in a permanent node storage.
     """
@@ -69,6 +75,27 @@ class NodeStore:
         loc = self.mapfile.get(nodeid)
         return NodeStorePoint(loc.lon, loc.lat)
 
+    def get_many(self, nodeids):
+        """ Look up the locations of a list of node ids in one go.
+
+            Returns a tuple with a NumPy array of shape (n, 2) containing
+            the x/y coordinates and a boolean array of length n which marks
+            the nodes that were found. The coordinates of nodes that are not
+            found (or None) are undefined.
+        """
+        coords = np.empty((len(nodeids), 2))
+        valid = np.ones(len(nodeids), dtype=bool)
+
+        getloc = self.mapfile.get
+        for i, nid in enumerate(nodeids):
+            try:
+                loc = getloc(nid)
+                coords[i] = (loc.lon, loc.lat)
+            except (KeyError, TypeError):
+                valid[i] = False
+
+        return coords, valid
+
     def __setitem__(self, nodeid, value):
         self.mapfile.set(nodeid, osm.Location(value.x, value.y))
 
@@ -87,3 +114,59 @@ class NodeStore:
         if hasattr(self, 'mapfile'):
             LOG.info("Used memory by index: %d", self.mapfile.used_memory())
             del self.mapfile
+
+
+class ReadOnlyNodeStore:
+    """ Provides read-only access to a node storage file written by NodeStore.
+
+        The file is memory-mapped directly as an array of fixed-point
+        lon/lat pairs indexed by node id. The osmium bindings are not
+        involved, so lookups are cheap and the mapped pages are shared
+        between all processes that open the same file.
+
+        Only the part of the file that exists at the time of opening is
+        visible to the store.
+    """
+
+    def __init__(self, filename):
+        if os.path.getsize(filename) > 0:
+            self.mapfile = np.memmap(filename, dtype=np.int32, mode='r').reshape(-1, 2)
+        else:
+            self.mapfile = np.empty((0, 2), dtype=np.int32)
+
+    def __del__(self):
+        self.close()
+
+    def __getitem__(self, nodeid):
+        if 0 <= nodeid < len(self.mapfile):
+            x, y = self.mapfile[nodeid].tolist()
+            if x != UNDEFINED_COORDINATE:
+                return NodeStorePoint(x / COORDINATE_PRECISION,
+                                      y / COORDINATE_PRECISION)
+
+        raise KeyError(nodeid)
+
+    def get_many(self, nodeids):
+        """ Look up the locations of a list of node ids in one go.
+            See NodeStore.get_many().
+        """
+        try:
+            ids = np.array(nodeids, dtype=np.int64)
+        except TypeError:
+            ids = np.fromiter((-1 if n is None else n for n in nodeids),
+                              dtype=np.int64, count=len(nodeids))
+
+        valid = (ids >= 0) & (ids < len(self.mapfile))
+        if not valid.any():
+            return np.zeros((len(ids), 2)), valid
+
+        raw = self.mapfile[np.where(valid, ids, 0)]
+        valid &= raw[:, 0] != UNDEFINED_COORDINATE
+
+        return raw / COORDINATE_PRECISION, valid
+
+    def close(self):
+        """ Close the underlying storage file.
+        """
+        if hasattr(self, 'mapfile'):
+            del self.mapfile
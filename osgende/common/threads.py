@@ -7,6 +7,7 @@ Helper classes for multi-threaded execution.
 """
 
 import logging
+import multiprocessing
 import threading
 import queue
 
@@ -108,6 +109,91 @@ class _WorkerQueueThreaded:
             w.join()
 
 
+class _WorkerQueueProcesses:
+    """ An implementation of the worker queue with separate processes.
+
+        The processes are forked, so that the processing function and its
+        owner do not need to be pickled. Only the tasks are sent to the
+        workers and must be picklable.
+
+        Forking a process with running threads may leave locks held by
+        those threads locked forever in the child. The queue therefore
+        refuses to start when other threads are alive.
+    """
+    def __init__(self, process_func, numprocesses, initfunc=None, shutdownfunc=None):
+        if threading.active_count() > 1:
+            raise RuntimeError("Cannot fork worker processes while other threads are running.")
+        self.numprocesses = numprocesses
+        ctx = multiprocessing.get_context('fork')
+        self.queue = ctx.Queue(10*self.numprocesses)
+
+        LOG.info("Using %d parallel processes.", self.numprocesses)
+
+        def worker_loop(task_queue):
+            if initfunc is not None:
+                initfunc()
+
+            while True:
+                req = task_queue.get()
+                if req is None:
+                    break
+
+                process_func(req)
+
+            if shutdownfunc is not None:
+                shutdownfunc()
+
+        self.workers = []
+        for _ in range(self.numprocesses):
+            worker = ctx.Process(target=worker_loop, args=(self.queue, ))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def add_task(self, data):
+        """Add an item to be processed to the queue.
+        """
+        while True:
+            try:
+                self.queue.put(data, True, 2)
+                break
+            except queue.Full:
+                self.check_worker_state()
+
+    def check_worker_state(self):
+        """ Check that all workers are still alive and haven't died from
+            an exception.
+        """
+        for worker in self.workers:
+            if not worker.is_alive():
+                LOG.critical("Internal error. Process died. Killing other processes.")
+                self.finish(True)
+                raise WorkerError("Internal error. Process died.")
+
+    def finish(self, flush=False):
+        """Wait for the processes to finish and then let them die.
+           See _WorkerQueueThreaded.finish().
+
+           Raises a WorkerError when one of the processes did not
+           exit cleanly because the work it has done is lost.
+        """
+        if flush:
+            for worker in self.workers:
+                worker.terminate()
+        else:
+            for _ in range(self.numprocesses):
+                self.queue.put(None)
+
+        LOG.debug("Waiting for processes to finish")
+        for w in self.workers:
+            w.join()
+
+        self.queue.close()
+
+        if not flush and any(w.exitcode != 0 for w in self.workers):
+            raise WorkerError("Internal error. Process died.")
+
+
 class WorkerQueue:
     """ Provides a queue and a pool of threads that process the tasks in the
         queue. Note that this class works for consumer threads only.
@@ -124,14 +210,24 @@ class WorkerQueue:
         single-threaded mode, 'initfunc' is called immediately and 'shutdownfunc'
         within finish().
 
+        If 'use_processes' is true, then the work is done in 'numthreads'
+        forked processes instead of threads. This gets around the GIL for
+        CPU-bound processing. The tasks must be picklable in this case and
+        'initfunc' and 'shutdownfunc' are called in the worker processes.
+        Processes can only be started from a process without any other
+        running threads.
     """
 
     numthreads = 0
 
-    def __init__(self, process_func, numthreads=None, initfunc=None, shutdownfunc=None):
+    def __init__(self, process_func, numthreads=None, initfunc=None, shutdownfunc=None,
+                 use_processes=False):
         numthreads = numthreads or self.numthreads
         if numthreads == 0:
             self.worker = _WorkerQueueSimple(process_func, initfunc, shutdownfunc)
+        elif use_processes:
+            self.worker = _WorkerQueueProcesses(process_func, numthreads,
+                                                initfunc, shutdownfunc)
         else:
             self.worker = _WorkerQueueThreaded(process_func, numthreads,
                                                initfunc, shutdownfunc)
@@ -161,24 +257,38 @@ class ThreadableDBObject:
     """
 
     numthreads = None
+    use_processes = False
 
-    def set_num_threads(self, num):
+    def set_num_threads(self, num, use_processes=False):
         """Set the number of worker threads to use when processing the
            table. Note that this is the number of additional threads
            created when processing, so the total number of threads in
            the system is num+1. Setting num to None (the default) disables
            parallel processing.
 
+           When 'use_processes' is true, the workers are run in separate
+           processes instead of threads. Each process opens its own
+           database connection. This cannot be combined with processing
+           tables in parallel threads.
         """
         self.numthreads = num
+        self.use_processes = use_processes
 
 
     def create_worker_queue(self, engine, processfunc):
         self.thread = threading.local()
         self.worker_engine = engine
         return WorkerQueue(processfunc, self.numthreads,
-                           self._init_worker_thread,
-                           self._shutdown_worker_thread)
+                           self._init_worker_process if self.use_processes
+                           else self._init_worker_thread,
+                           self._shutdown_worker_thread,
+                           use_processes=self.use_processes)
+
+    def _init_worker_process(self):
+        # The connection pool was inherited from the parent process and
+        # must not be touched by the child.
+        self.worker_engine.dispose(close=False)
+        self._init_worker_thread()
 
     def _init_worker_thread(self):
         LOG.debug("Initialising worker...")
@@ -28,6 +28,10 @@ class TransformedTable(ThreadableDBObject, TableSource):
 
         This is an incomplete table that needs to be subclassed. Define
         two functions: add_columns() and transform()
+
+        Updates stream the changed rows from the source and write them back
+        in chunks. The chunk size may be set with the 'update_chunk_size'
+        entry in the metadata info field.
     """
 
     def __init__(self, meta, name, source):
@@ -41,6 +45,7 @@ class TransformedTable(ThreadableDBObject, TableSource):
         super().__init__(table, name + "_changeset")
 
         self.src = source
+        self.update_chunk_size = meta.info.get('update_chunk_size', 10000)
 
     def construct(self, engine):
         sql = self.src.data.select()
@@ -77,42 +82,46 @@ class TransformedTable(ThreadableDBObject, TableSource):
 
         j = s.join(d, d.c.id == s.c.id, full = True)
         sql = sa.select(*cols).select_from(j)\
-                .where(self.src.c.id.in_(self.src.select_add_modify()))
-
-        deleted = []
-        inserts = []
-        for obj in conn.execute(sql):
-            oid = obj.id
-            is_added = obj.old_id is None
-
-            if oid is None:
-                deleted.append({'oid' : obj.old_id})
-                changeset[obj.old_id] = 'D'
-                continue
-
-            cols = self.transform(obj)
-            if cols is None:
-                if not is_added:
-                    deleted.append({'oid' : oid})
-                    changeset[oid] = 'D'
-                continue
-
-            changed = False
-            for k, v in cols.items():
-                if str(obj._mapping['old_' + k]) != str(v):
-                    changed = True
-                    break
-
-            if changed:
-                cols['id'] = oid
-                inserts.append(cols)
-                changeset[oid] = 'A' if is_added else 'M'
-
-        if len(inserts):
-            conn.execute(self.upsert_data().values(inserts))
-        if len(deleted):
-            conn.execute(self.data.delete().where(d.c.id == sa.bindparam('oid')),
-                         deleted)
+                .where(self.src.c.id.in_(self.src.select_add_modify()))\
+                .execution_options(yield_per=self.update_chunk_size)
+
+        # The result is streamed through a server-side cursor, which
+        # still sees the data as it was before the chunks are written.
+        for chunk in conn.execute(sql).partitions():
+            deleted = []
+            inserts = []
+            for obj in chunk:
+                oid = obj.id
+                is_added = obj.old_id is None
+
+                if oid is None:
+                    deleted.append({'oid' : obj.old_id})
+                    changeset[obj.old_id] = 'D'
+                    continue
+
+                cols = self.transform(obj)
+                if cols is None:
+                    if not is_added:
+                        deleted.append({'oid' : oid})
+                        changeset[oid] = 'D'
+                    continue
+
+                changed = False
+                for k, v in cols.items():
+                    if str(obj._mapping['old_' + k]) != str(v):
+                        changed = True
+                        break
+
+                if changed:
+                    cols['id'] = oid
+                    inserts.append(cols)
+                    changeset[oid] = 'A' if is_added else 'M'
+
+            if len(inserts):
+                conn.execute(self.upsert_data().values(inserts))
+            if len(deleted):
+                conn.execute(self.data.delete().where(d.c.id == sa.bindparam('oid')),
+                             deleted)
 
 
     def _process_construct_next(self, obj):
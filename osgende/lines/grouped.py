@@ -16,11 +16,15 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 from osgende.common.table import TableSource
-from osgende.common.sqlalchemy import DropIndexIfExists
+from osgende.common.sqlalchemy import DropIndexIfExists, Truncate
+from osgende.common.bulk import BulkInserter
 from sqlalchemy.dialects.postgresql import ARRAY, insert
 
 import sqlalchemy as sa
 
+def _bigint_array(values):
+    return sa.literal(list(values), ARRAY(sa.BigInteger))
+
 class GroupedWayTable(TableSource):
     """ Table that groups ways of the source table and assigns them
         a new id.
@@ -28,9 +32,15 @@ class GroupedWayTable(TableSource):
         Ways are grouped when they share a given list of attribures and
         at least one node. The source must contain the nodes list of the
         way.
+
+        When `node_index` is true, an additional table <name>_nodes is
+        maintained which maps the nodes of all grouped ways to their group.
+        Updates then only regroup the ways around the changed ways in
+        one go instead of re-walking the affected groups way by way. A
+        group keeps its id as long as it contains one of its former ways.
     """
 
-    def __init__(self, meta, name, source, rows):
+    def __init__(self, meta, name, source, rows, node_index=False):
         table = sa.Table(name, meta,
                          sa.Column('id', sa.BigInteger),
                          sa.Column('child', source.c.id.type, unique=True, index=True))
@@ -39,6 +49,21 @@ class GroupedWayTable(TableSource):
 
         self.rows = rows
         self.src = source
+        self.copy_batch_size = meta.info.get('copy_batch_size', 1000)
+
+        if node_index:
+            self.node_index = sa.Table(name + '_nodes', meta,
+                                       sa.Column('node', sa.BigInteger, index=True),
+                                       sa.Column('id', sa.BigInteger, index=True))
+            self.update = self.update_indexed
+        else:
+            self.node_index = None
+
+    def create_table(self, engine):
+        self.data.create(bind=engine, checkfirst=True)
+        self.change.create(bind=engine, checkfirst=True)
+        if self.node_index is not None:
+            self.node_index.create(bind=engine, checkfirst=True)
 
     def _select_src(self):
         rows = [self.src.c[r] for r in self.rows]
@@ -48,22 +73,214 @@ class GroupedWayTable(TableSource):
 
     def construct(self, engine):
         """ Create full table content from the source table.
+
+            The source is read once, sorted by properties. The ways of
+            each property group are then grouped in memory.
         """
         with engine.begin() as conn:
             self.truncate(conn)
+            if self.node_index is not None:
+                conn.execute(Truncate(self.node_index))
+
+        sql = self._select_src().order_by(*(self.src.c[r] for r in self.rows),
+                                          self.src.c.id)
 
-        done = set()
         with engine.begin() as conn, engine.begin() as iconn:
-            cur = conn.execution_options(stream_results=True).execute(self._select_src())
+            writer = BulkInserter(iconn, self.data, self.copy_batch_size)
+            cur = conn.execution_options(stream_results=True).execute(sql)
 
+            prev_prop = None
+            wayset = []
             for obj in cur:
-                oid = obj.id
-                if oid in done:
-                    # already has an id
+                prop = [obj._mapping[name] for name in self.rows]
+                if prev_prop is not None and prop != prev_prop:
+                    self._write_groups(wayset, writer)
+                    wayset = []
+                wayset.append((obj.id, obj.nodes))
+                prev_prop = prop
+
+            self._write_groups(wayset, writer)
+            writer.flush()
+
+        if self.node_index is not None:
+            with engine.begin() as conn:
+                conn.execute(self._insert_node_index())
+
+    @classmethod
+    def _write_groups(cls, ways, writer):
+        """ Write out all groups with more than one way from the given
+            list of (id, nodes) tuples. The ways must be sorted by id.
+            The smallest way id becomes the id of the group.
+        """
+        for gid, members in cls._find_groups(ways).items():
+            if len(members) > 1:
+                for wid in members:
+                    writer.add({'id': gid, 'child': wid})
+
+    @staticmethod
+    def _find_groups(ways):
+        """ Find connected ways in the given list of (id, nodes) tuples
+            using a union-find over the shared nodes. Returns a dictionary
+            of the smallest way id of each group to the list of ways in
+            the group.
+        """
+        parent = {}
+
+        def _find(wid):
+            root = wid
+            while parent[root] != root:
+                root = parent[root]
+            while parent[wid] != root:
+                parent[wid], wid = root, parent[wid]
+            return root
+
+        node_owner = {}
+        for wid, nodes in ways:
+            parent[wid] = wid
+            for nid in nodes or ():
+                if nid is None:
                     continue
+                other = node_owner.setdefault(nid, wid)
+                if other != wid:
+                    root1 = _find(other)
+                    root2 = _find(wid)
+                    if root1 < root2:
+                        parent[root2] = root1
+                    elif root2 < root1:
+                        parent[root1] = root2
+
+        groups = {}
+        for wid, _ in ways:
+            groups.setdefault(_find(wid), []).append(wid)
+
+        return groups
+
+    def _insert_node_index(self, gids=None):
+        """ Return the SQL that adds the nodes of the given groups
+            (or all groups) to the node index.
+        """
+        s = self.src.data
+        sql = sa.select(sa.func.unnest(s.c.nodes).label('node'), self.c.id)\
+                .where(s.c.id == self.c.child)
+        if gids is not None:
+            sql = sql.where(self.c.id == sa.any_(_bigint_array(gids)))
+
+        return self.node_index.insert().from_select(['node', 'id'], sql.distinct())
 
-                done.update(self._insert_adjacent_ways((oid, obj.nodes),
-                                                       obj, iconn))
+    def update_indexed(self, engine):
+        """ Update the groups using the node index.
+
+            All ways which might be connected to a changed way are
+            collected with a few set-based queries and then regrouped
+            in memory.
+        """
+        s = self.src.data
+        idx = self.node_index
+
+        with engine.begin() as conn:
+            changed = set(conn.scalars(sa.select(self.src.cc.id)))
+            if not changed:
+                self.write_change_table(conn, {})
+                return
+
+            nodes = set()
+            for row in conn.execute(sa.select(s.c.nodes)
+                                      .where(s.c.id.in_(self.src.select_add_modify()))):
+                nodes.update(n for n in row.nodes or () if n is not None)
+
+            # Groups that contain changed ways or touch their nodes.
+            gids = set(conn.scalars(sa.select(self.c.id).distinct()
+                                      .where(self.c.child.in_(sa.select(self.src.cc.id)))))
+            if nodes:
+                gids.update(conn.scalars(sa.select(idx.c.id).distinct()
+                                           .where(idx.c.node == sa.any_(_bigint_array(nodes)))))
+
+            old_groups = {}
+            if gids:
+                for row in conn.execute(sa.select(self.c.id, self.c.child)
+                                          .where(self.c.id == sa.any_(_bigint_array(gids)))):
+                    old_groups.setdefault(row.id, set()).add(row.child)
+
+            # All ways that need regrouping: the changed ways, the members
+            # of the affected groups and any ungrouped way touching the
+            # changed ways.
+            candidates = set(changed)
+            for members in old_groups.values():
+                candidates.update(members)
+            if nodes:
+                candidates.update(conn.scalars(sa.select(s.c.id)
+                                    .where(s.c.nodes.overlap(_bigint_array(nodes)))))
+
+            sql = self._select_src()\
+                      .where(s.c.id == sa.any_(_bigint_array(candidates)))\
+                      .order_by(*(self.src.c[r] for r in self.rows), s.c.id)
+            components = []
+            prev_prop = None
+            wayset = []
+            for obj in conn.execute(sql):
+                prop = [obj._mapping[name] for name in self.rows]
+                if prev_prop is not None and prop != prev_prop:
+                    components.extend(self._find_groups(wayset).values())
+                    wayset = []
+                wayset.append((obj.id, obj.nodes))
+                prev_prop = prop
+            components.extend(self._find_groups(wayset).values())
+
+            # Ids of untouched groups must not be reused.
+            used = set(conn.scalars(sa.select(self.c.id).distinct()
+                                      .where(self.c.id == sa.any_(_bigint_array(candidates)))))
+            used -= gids
+
+            new_groups = self._assign_group_ids(
+                            [c for c in components if len(c) > 1],
+                            old_groups, changed, used)
+
+            # Replace the affected groups.
+            if gids:
+                conn.execute(self.data.delete()
+                               .where(self.c.id == sa.any_(_bigint_array(gids))))
+                conn.execute(idx.delete()
+                               .where(idx.c.id == sa.any_(_bigint_array(gids))))
+            if new_groups:
+                conn.execute(self.data.insert(),
+                             [{'id': gid, 'child': wid}
+                              for gid, members in new_groups.items() for wid in members])
+                conn.execute(self._insert_node_index(new_groups.keys()))
+
+            # Member ways of surviving groups may have changed even when
+            # the membership did not, so they are always reported.
+            changes = {gid: 'M' if gid in new_groups else 'D' for gid in old_groups}
+            for gid in new_groups:
+                if gid not in old_groups:
+                    changes[gid] = 'A'
+
+            self.write_change_table(conn, changes)
+
+    @staticmethod
+    def _assign_group_ids(components, old_groups, changed, used):
+        """ Choose ids for the newly computed groups in `components`.
+
+            A group reuses the smallest id of the former groups its ways
+            belonged to. Otherwise the smallest id of a changed way in the
+            group is taken or, failing that, the smallest way id. Ids in
+            `used` and ids already given out are skipped.
+        """
+        member_of = {}
+        for gid, members in old_groups.items():
+            for wid in members:
+                member_of[wid] = gid
+
+        new_groups = {}
+        for members in components:
+            choices = sorted(set(member_of[w] for w in members if w in member_of))
+            choices.extend(sorted(w for w in members if w in changed))
+            choices.extend(sorted(members))
+            for gid in choices:
+                if gid not in used and gid not in new_groups:
+                    new_groups[gid] = members
+                    break
+
+        return new_groups
 
 
     def update(self, engine):
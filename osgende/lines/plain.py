@@ -15,15 +15,38 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import struct
+
+import numpy as np
 from osgende.common.table import TableSource
 from sqlalchemy.dialects.postgresql import ARRAY, array
 import sqlalchemy as sa
 from geoalchemy2 import Geometry
-from geoalchemy2.shape import from_shape, to_shape
-from shapely.geometry import LineString
 
 from osgende.common.sqlalchemy import DropIndexIfExists
 from osgende.common.threads import ThreadableDBObject
+from osgende.common.bulk import BulkInserter
+from osgende.common.build_geometry import build_linestrings, project_to_mercator
+
+def _linestring_coords(wkb):
+    """ Return the coordinates of a line string given as (E)WKB bytes
+        or hex string as a NumPy array of shape (n, 2). Returns None if the geometry is
+        not a 2D line string.
+    """
+    data = bytes.fromhex(wkb) if isinstance(wkb, str) else bytes(wkb)
+    order = '<' if data[0] == 1 else '>'
+    gtype, = struct.unpack_from(order + 'I', data, 1)
+    offset = 5
+    if gtype & 0x20000000:
+        offset += 4
+        gtype &= ~0x20000000
+    if gtype != 2:
+        return None
+    npoints, = struct.unpack_from(order + 'I', data, offset)
+
+    return np.frombuffer(data, dtype=order + 'f8', count=2 * npoints,
+                         offset=offset + 4).reshape((npoints, 2))
+
 
 class PlainWayTable(ThreadableDBObject, TableSource):
     """Table that transforms columns and adds a LineString geometry column
@@ -39,7 +62,16 @@ class PlainWayTable(ThreadableDBObject, TableSource):
        implementation just copies all data verbatim.
 
        This table creates its own changeset table which also takes into
-       account changes to the geometry.
+       account changes to the geometry. On updates, the geometry of a way
+       is only rebuilt when its node list has changed or one of its nodes
+       in the node changeset has moved.
+
+       During construction, the source rows are handed to the workers in
+       chunks, whose geometries are computed together. The chunk size may
+       be set with the 'construct_chunk_size' entry in the metadata info
+       field. Each worker thread buffers the computed rows and writes them
+       out in batches. The batch size may be set with the 'copy_batch_size'
+       entry in the metadata info field.
     """
 
     def __init__(self, meta, name, source, osmdata):
@@ -58,7 +90,10 @@ class PlainWayTable(ThreadableDBObject, TableSource):
         self.osmdata = osmdata
         self.src = source
 
-        self.set_num_threads(meta.info.get('num_threads', 1))
+        self.set_num_threads(meta.info.get('num_threads', 1),
+                             meta.info.get('use_processes', False))
+        self.copy_batch_size = meta.info.get('copy_batch_size', 1000)
+        self.construct_chunk_size = meta.info.get('construct_chunk_size', 1000)
 
     @property
     def srid(self):
@@ -82,11 +117,12 @@ class PlainWayTable(ThreadableDBObject, TableSource):
             self.truncate(conn)
 
         # insert
-        sql = self.src.data.select()
+        sql = self.src.data.select()\
+                .execution_options(yield_per=self.construct_chunk_size)
         workers = self.create_worker_queue(engine, self._process_construct_next)
-        with engine.execution_options(stream_results=True).begin() as conn:
-            for obj in conn.execute(sql):
-                workers.add_task(obj)
+        with engine.begin() as conn:
+            for chunk in conn.execute(sql).partitions():
+                workers.add_task(chunk)
 
         workers.finish()
 
@@ -94,31 +130,56 @@ class PlainWayTable(ThreadableDBObject, TableSource):
             ndsidx.create(conn)
 
 
-    def _process_construct_next(self, obj):
-        cols = self._construct_row(obj, self.thread.conn)
+    def _init_worker_thread(self):
+        super()._init_worker_thread()
+        self.thread.writer = BulkInserter(self.thread.conn, self.data,
+                                          self.copy_batch_size)
+
+    def _shutdown_worker_thread(self):
+        self.thread.writer.flush()
+        super()._shutdown_worker_thread()
+
+    def _process_construct_next(self, objs):
+        for cols in self._construct_rows(objs, self.thread.conn):
+            self.thread.writer.add(cols)
+
 
-        if cols is not None:
-            self.thread.conn.execute(self.data.insert().values(cols))
+    def _construct_rows(self, objs, conn):
+        """ Compute the rows for the given list of source objects. The
+            node locations are looked up and the geometries are built all
+            at once. Objects that have no valid geometry or are rejected by
+            transform_tags() are left out.
+        """
+        rows = []
+        for obj in objs:
+            cols = self.transform_tags(obj)
+            if cols is not None:
+                cols['id'] = obj.id
+                cols['nodes'] = obj.nodes
+                rows.append(cols)
 
+        coords = self._get_coords_many([cols['nodes'] for cols in rows], conn)
+        for cols, geom in zip(rows, build_linestrings(coords, self.srid)):
+            cols['geom'] = geom
 
-    def _construct_row(self, obj, conn):
-        cols = self.transform_tags(obj)
-        if cols is None:
-            return None
+        return [cols for cols in rows if cols['geom'] is not None]
 
-        points = self.osmdata.get_points(obj.nodes, conn)
-        if len(points) <= 1:
-            return None
 
+    def _get_coords(self, nodes, conn):
+        coords = self.osmdata.get_coords(nodes, conn)
         if self.srid == 3857:
-            points = [p.to_mercator() for p in points]
+            coords = project_to_mercator(coords)
 
-        cols['geom'] = from_shape(LineString(points), srid=self.srid)
+        return coords
 
-        cols['id'] = obj.id
-        cols['nodes'] = obj.nodes
 
-        return cols
+    def _get_coords_many(self, node_lists, conn):
+        coords = self.osmdata.get_coords_many(node_lists, conn)
+        if self.srid == 3857 and coords:
+            splits = np.cumsum([len(c) for c in coords[:-1]])
+            coords = np.split(project_to_mercator(np.concatenate(coords)), splits)
+
+        return coords
 
 
     def transform_tags(self, obj):
@@ -151,7 +212,7 @@ class PlainWayTable(ThreadableDBObject, TableSource):
         d = self.data
         s = self.src.data
 
-        cols = [s]
+        cols = [s, d.c.nodes.label('old_nodes')]
         for c in d.columns:
             if c.name not in ('id', 'nodes'):
                 cols.append(c.label('old_' + c.name))
@@ -162,7 +223,8 @@ class PlainWayTable(ThreadableDBObject, TableSource):
         od = self.data.alias("old")
         ndsql = sa.select(od.c.id)\
                   .where(od.c.nodes.overlap(array([self.osmdata.node.cc.id])))\
-                  .where(self.osmdata.node.cc.action != 'D')
+                  .where(self.osmdata.node.cc.action != 'D')\
+                  .where(self.osmdata.node_moved())
         # combine both to get the id of modified ways
         idsql = sa.union(waysql, ndsql).alias('ids')
 
@@ -171,8 +233,11 @@ class PlainWayTable(ThreadableDBObject, TableSource):
         sql = sa.select(*cols).select_from(j)\
                  .where(s.c.id == idsql.c.id)
 
+        node_changes = self._get_node_changes(conn)
+
         deleted = []
         inserts = []
+        rebuilt = []
         changeset = {}
         for obj in conn.execute(sql):
             oid = obj.id
@@ -194,19 +259,24 @@ class PlainWayTable(ThreadableDBObject, TableSource):
                     changed = True
                     break
 
-            points = self.osmdata.get_points(obj.nodes, conn)
-            if len(points) <= 1:
-                if not is_added:
-                    deleted.append({'oid': oid})
-                    changeset[oid] = 'D'
-                continue
-
-            if self.srid == 3857:
-                points = [p.to_mercator() for p in points]
-
-            new_geom = LineString(points)
-            cols['geom'] = from_shape(new_geom, srid=self.srid)
-            changed = changed or is_added or (new_geom != to_shape(obj.old_geom))
+            if not is_added and self._has_same_geometry(obj, node_changes):
+                if not changed:
+                    continue
+                cols['geom'] = obj.old_geom
+            else:
+                coords = self._get_coords(obj.nodes, conn)
+                if len(coords) <= 1:
+                    if not is_added:
+                        deleted.append({'oid': oid})
+                        changeset[oid] = 'D'
+                    continue
+
+                if not (changed or is_added):
+                    old_coords = _linestring_coords(obj.old_geom.data)
+                    changed = old_coords is None\
+                              or not np.array_equal(old_coords, coords)
+                if changed:
+                    rebuilt.append((cols, coords))
 
             if changed:
                 cols['nodes'] = obj.nodes
@@ -214,6 +284,10 @@ class PlainWayTable(ThreadableDBObject, TableSource):
                 inserts.append(cols)
                 changeset[oid] = 'A' if is_added else 'M'
 
+        for (cols, _), geom in zip(rebuilt, build_linestrings([c for _, c in rebuilt],
+                                                              self.srid)):
+            cols['geom'] = geom
+
         if len(inserts):
             conn.execute(self.upsert_data().values(inserts))
         if len(deleted):
@@ -221,3 +295,58 @@ class PlainWayTable(ThreadableDBObject, TableSource):
                          deleted)
 
         return changeset
+
+
+    def _get_node_changes(self, conn):
+        """ Return a dictionary of the nodes in the node changeset that
+            may have moved with their new coordinates in the SRID of the
+            table. Deleted nodes have the coordinates set to None.
+        """
+        nc = self.osmdata.node.cc
+        sql = sa.select(nc.id, nc.action,
+                        nc.geom.ST_X().label('x'), nc.geom.ST_Y().label('y'))\
+                .where(self.osmdata.node_moved())
+
+        changes = {}
+        ids = []
+        coords = []
+        for row in conn.execute(sql):
+            if row.action == 'D' or row.x is None:
+                changes[row.id] = None
+            else:
+                ids.append(row.id)
+                coords.append((row.x, row.y))
+
+        if coords:
+            coords = np.array(coords, dtype=np.float64)
+            if self.srid == 3857:
+                coords = project_to_mercator(coords)
+            changes.update(zip(ids, map(tuple, coords.tolist())))
+
+        return changes
+
+
+    @staticmethod
+    def _has_same_geometry(obj, node_changes):
+        """ Check from the node changes alone, if the geometry of the way
+            would come out unchanged when it is rebuilt. The check is
+            conservative: when in doubt, it returns False.
+        """
+        if obj.old_nodes is None or list(obj.old_nodes) != list(obj.nodes):
+            return False
+
+        moved = [(i, node_changes[n]) for i, n in enumerate(obj.nodes)
+                 if n in node_changes]
+        if not moved:
+            return True
+
+        if any(c is None for _, c in moved):
+            return False
+
+        coords = _linestring_coords(obj.old_geom.data)
+        # Unresolvable nodes are dropped from the geometry, in which case
+        # the node positions cannot be matched anymore.
+        if coords is None or len(coords) != len(obj.nodes):
+            return False
+
+        return all(coords[i, 0] == x and coords[i, 1] == y for i, (x, y) in moved)
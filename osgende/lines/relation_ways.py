@@ -3,16 +3,21 @@
 # This file is part of Osgende
 # Copyright (C) 2022 Sarah Hoffmann
 
+import warnings
+
+import numpy as np
 import sqlalchemy as sa
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB, array_agg, array
 from geoalchemy2 import Geometry
 from geoalchemy2.shape import from_shape, to_shape
-import shapely.geometry as sgeom
+import shapely
 
 from osgende.common.table import TableSource
 from osgende.common.sqlalchemy import CreateView, DropIndexIfExists, Truncate
 from osgende.common.tags import TagStore
 from osgende.common.threads import ThreadableDBObject
+from osgende.common.build_geometry import project_to_mercator
+from osgende.common.nodestore import NodeStorePoint
 
 
 class RelationWayTable(ThreadableDBObject, TableSource):
@@ -37,6 +42,14 @@ class RelationWayTable(ThreadableDBObject, TableSource):
 
         The table creates an additional view on the relation table
         of the relation-way relationship."
+
+        During construction, the ways are handed to the workers in chunks
+        of 'construct_chunk_size' (from the metadata info field) and the
+        node locations are looked up for the whole chunk at once.
+
+        Geometries are created with make_geometry_from_coords(). Subclasses
+        that overwrite the older make_geometry() still work but this is
+        deprecated.
     """
 
     def __init__(self, meta, name, way_src, relation_src, osmdata=None):
@@ -67,7 +80,14 @@ class RelationWayTable(ThreadableDBObject, TableSource):
                                       sa.Column('relation_id', sa.BigInteger),
                                       sa.Column('way_id', sa.BigInteger))
 
-        self.set_num_threads(meta.info.get('num_threads', 1))
+        self.set_num_threads(meta.info.get('num_threads', 1),
+                             meta.info.get('use_processes', False))
+        self.construct_chunk_size = meta.info.get('construct_chunk_size', 1000)
+
+        if self._has_custom_make_geometry():
+            warnings.warn(f"{type(self).__name__}: overwriting make_geometry() is deprecated."
+                          " Overwrite make_geometry_from_coords() instead.",
+                          DeprecationWarning, stacklevel=2)
 
     @property
     def srid(self):
@@ -111,12 +131,13 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         if hasattr(self, 'transform_tags'):
             cols.append(w.c.tags)
 
-        sql = sa.select(*cols).where(w.c.id == sub.c.way_id)
+        sql = sa.select(*cols).where(w.c.id == sub.c.way_id)\
+                .execution_options(yield_per=self.construct_chunk_size)
         workers = self.create_worker_queue(engine, self._process_construct_next)
 
-        with engine.execution_options(stream_results=True).begin() as conn:
-            for obj in conn.execute(sql):
-                workers.add_task(obj)
+        with engine.begin() as conn:
+            for chunk in conn.execute(sql).partitions():
+                workers.add_task(chunk)
 
         workers.finish()
 
@@ -155,7 +176,8 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         if with_geom:
             nc = self.osmdata.node.cc.id
             sql_ndchg = sa.select(d.c.id)\
-                          .where(d.c.nodes.overlap(array([nc])))
+                          .where(d.c.nodes.overlap(array([nc])))\
+                          .where(self.osmdata.node_moved())
             sql_idchg = sa.union(sql_idchg, sql_ndchg)
 
         sql_idchg = sql_idchg.alias('ids')
@@ -197,10 +219,8 @@ class RelationWayTable(ThreadableDBObject, TableSource):
                 # Always rebuild the geometry when with_geom as nodes might have
                 # moved.
                 if with_geom:
-                    points = self.osmdata.get_points(obj.new_nodes, inner)
-                    if self.srid == 3857:
-                        points = [p.to_mercator() for p in points]
-                    new_geom = self.make_geometry(points)
+                    new_geom = self.make_geometry_from_coords(
+                                   self._get_coords(obj.new_nodes, inner))
                     if new_geom is None:
                         deletes.append({'oid' : oid})
                         changeset[oid] = 'D'
@@ -227,11 +247,44 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         return changeset
 
 
+    def make_geometry_from_coords(self, coords):
+        """ Create the geometry for a way. `coords` is a NumPy array of
+            shape (n, 2) with the coordinates of the way in the target
+            SRID. Returns a Shapely geometry or None if no geometry can be
+            created.
+
+            If a subclass overwrites make_geometry(), the coordinates are
+            handed to that function instead.
+        """
+        if self._has_custom_make_geometry():
+            return self.make_geometry([NodeStorePoint(x, y) for x, y in coords.tolist()])
+
+        if len(coords) <= 1:
+            return None
+
+        return shapely.linestrings(coords)
+
     def make_geometry(self, points):
+        """ Create the geometry for a way from a list of NodeStorePoint
+            in the target SRID. Returns a Shapely geometry or None if no
+            geometry can be created.
+
+            Deprecated: overwrite make_geometry_from_coords() instead.
+        """
         if len(points) <= 1:
             return None
 
-        return sgeom.LineString(points)
+        return shapely.LineString(points)
+
+    def _has_custom_make_geometry(self):
+        return type(self).make_geometry is not RelationWayTable.make_geometry
+
+    def _get_coords(self, nodes, conn):
+        coords = self.osmdata.get_coords(nodes, conn)
+        if self.srid == 3857:
+            coords = project_to_mercator(coords)
+
+        return coords
 
 
     def _update_handle_changed_rels(self, engine):
@@ -300,14 +353,9 @@ class RelationWayTable(ThreadableDBObject, TableSource):
 
         sql = sa.select(*cols).where(w.c.id == sub.c.way_id)
 
-        changeset = {}
-        inserts = []
-        with engine.begin() as conn, engine.begin() as inner:
-            for obj in conn.execute(sql):
-                cols = self._construct_row(obj, inner)
-                if cols is not None:
-                    changeset[obj.way_id] = 'A'
-                    inserts.append(cols)
+        with engine.begin() as conn:
+            inserts = self._construct_rows(conn.execute(sql).all(), conn)
+        changeset = {cols['id']: 'A' for cols in inserts}
 
         if len(inserts):
             with engine.begin() as conn:
@@ -315,14 +363,37 @@ class RelationWayTable(ThreadableDBObject, TableSource):
 
         return changeset
 
-    def _process_construct_next(self, obj):
-        cols = self._construct_row(obj, self.thread.conn)
+    def _process_construct_next(self, objs):
+        rows = self._construct_rows(objs, self.thread.conn)
+
+        if rows:
+            self.thread.conn.execute(self.data.insert().values(rows))
+
+
+    def _construct_rows(self, objs, conn):
+        """ Compute the rows for the given list of source objects. The
+            node locations of all objects are looked up at once.
+            Objects without a valid geometry or that are rejected by
+            transform_tags() are left out.
+        """
+        if self.osmdata is None:
+            coords = [None] * len(objs)
+        else:
+            coords = self.osmdata.get_coords_many([o.nodes for o in objs], conn)
+            if self.srid == 3857 and coords:
+                splits = np.cumsum([len(c) for c in coords[:-1]])
+                coords = np.split(project_to_mercator(np.concatenate(coords)), splits)
+
+        rows = []
+        for obj, points in zip(objs, coords):
+            cols = self._construct_row(obj, points)
+            if cols is not None:
+                rows.append(cols)
 
-        if cols is not None:
-            self.thread.conn.execute(self.data.insert().values(cols))
+        return rows
 
 
-    def _construct_row(self, obj, conn):
+    def _construct_row(self, obj, points):
         if hasattr(self, 'transform_tags'):
             cols = self.transform_tags(obj.way_id, TagStore(obj.tags))
             if cols is None:
@@ -331,10 +402,7 @@ class RelationWayTable(ThreadableDBObject, TableSource):
             cols = {}
 
         if self.osmdata is not None:
-            points = self.osmdata.get_points(obj.nodes, conn)
-            if self.srid == 3857:
-                points = [p.to_mercator() for p in points]
-            new_geom = self.make_geometry(points)
+            new_geom = self.make_geometry_from_coords(points)
             if new_geom is None:
                 return
             cols['geom'] = from_shape(new_geom, srid=self.srid)
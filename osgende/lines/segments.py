@@ -4,20 +4,22 @@
 # Copyright (C) 2022 Sarah Hoffmann
 
 import logging
+import tempfile
+from array import array
 from collections import Counter, defaultdict
 
+import numpy as np
 import sqlalchemy as sa
 import sqlalchemy.sql.functions as saf
-import osgende.common.sqlalchemy as osa
 from sqlalchemy.dialects.postgresql import ARRAY
-from geoalchemy2.shape import from_shape, to_shape
+from geoalchemy2.shape import to_shape
 from sqlalchemy.dialects import postgresql
 
-from shapely.geometry import LineString
 
 from osgende.common.threads import ThreadableDBObject
 from osgende.common.table import TableSource
-from osgende.common.sqlalchemy import DropIndexIfExists, Truncate
+from osgende.common.bulk import BulkInserter, linestring_ewkb
+from osgende.common.sqlalchemy import DropIndexIfExists
 
 log = logging.getLogger(__name__)
 
@@ -44,6 +46,18 @@ class SegmentsTable(ThreadableDBObject, TableSource):
        This table creates its own new space of unique identifiers in the
        `id` column and a separate changeset table called <name>_changeset
        which refers to these ids.
+
+       Ways with identical properties are processed together. Large sets
+       are split into independent parts that cannot be fused with each
+       other. These are then handed to the workers in spatially sorted
+       batches of up to 'segments_task_size' ways (to be set in the
+       metadata info field, default 10000).
+
+       The intersections between ways are computed by the database by
+       default. When the metadata info field 'segments_count_nodes' is set,
+       they are counted in Python while streaming the node lists of the
+       source instead. 'segments_spill_dir' may then point to a directory
+       where the node counts are kept on disk.
     """
 
     def __init__(self, meta, name, source, prop_cols):
@@ -67,10 +81,12 @@ class SegmentsTable(ThreadableDBObject, TableSource):
         super().__init__(table, name + "_changeset")
 
         self.src = source
-        self.set_num_threads(meta.info.get('num_threads', 1))
-
-    def set_num_threads(self, num):
-        self.numthreads = num
+        self.task_size = meta.info.get('segments_task_size', 10000)
+        self.copy_batch_size = meta.info.get('copy_batch_size', 1000)
+        self.count_nodes = meta.info.get('segments_count_nodes', False)
+        self.spill_dir = meta.info.get('segments_spill_dir')
+        self.set_num_threads(meta.info.get('num_threads', 1),
+                             meta.info.get('use_processes', False))
 
     @property
     def srid(self):
@@ -98,7 +114,8 @@ class SegmentsTable(ThreadableDBObject, TableSource):
             self.truncate(conn)
 
         wayproc = _WayCollector(self, engine, creation_mode=True,
-                                numthreads=self.numthreads)
+                                numthreads=self.numthreads,
+                                use_processes=self.use_processes)
 
         with engine.begin() as conn:
             # get all ways sorted by property columns
@@ -130,7 +147,8 @@ class SegmentsTable(ThreadableDBObject, TableSource):
         """ Update changed segments.
         """
         wayproc = _WayCollector(self, engine, creation_mode=False,
-                                numthreads=self.numthreads)
+                                numthreads=self.numthreads,
+                                use_processes=self.use_processes)
         waysdone = set()
 
         with engine.begin() as conn:
@@ -151,30 +169,24 @@ class SegmentsTable(ThreadableDBObject, TableSource):
             waysel = sa.select(self.src.cc.id.label('tid'))
             segchg = sa.select(saf.func.unnest(self.c.nodes).label('tid'))\
                        .where(self.c.ways.op('&& ARRAY')(waysel.scalar_subquery()))
-            conn.execute(sa.text('DROP TABLE IF EXISTS __temp_updated_nodes'))
-            conn.execute(osa.CreateTableAs('__temp_updated_nodes',
-                                           sa.union(segchg, waychg).alias('sub'),
-                                           temporary=False))
-            temp_nodes = sa.Table('__temp_updated_nodes', sa.MetaData(),
-                                  autoload_with=conn)
-
-            if log.isEnabledFor(logging.DEBUG):
-                log.debug("Nodes needing updating: %s",
-                          [x for x in conn.execute(temp_nodes.select())])
 
-            deleted_ids = {}
-            # throw out all segments that have one of these points
+            # find all segments that have one of these points
             log.info("Segments with bad intersections...")
-            # SQLAlchemy cannot produce DELETE FROM ... USING syntax
-            # Falling back to handwritten SQL instead.
-            q = """%s USING __temp_updated_nodes
-                    WHERE nodes && ARRAY[__temp_updated_nodes.tid]
-                    RETURNING id, ways""" \
-                 % (str(self.data.delete()))
-
+            sql = sa.select(self.c.id, self.c.ways)\
+                    .where(self.c.nodes.op('&& ARRAY')(
+                               sa.union(segchg, waychg).scalar_subquery()))
+
+            # Replacing segments may pull in additional ways, whose inner
+            # nodes in turn may be shared with further segments. Repeat
+            # with the new set of nodes until the closure is complete.
+            # The segments are only deleted once the new ones are written.
+            deleted_ids = {}
+            params = {}
             while True:
                 additional_ways = set()
-                for c in conn.execute(sa.text(q)):
+                for c in conn.execute(sql, params):
+                    if c.id in deleted_ids:
+                        continue
                     additional_ways.update(w for w in c.ways if w not in waysdone)
                     deleted_ids[c.id] = 'D'
 
@@ -182,9 +194,9 @@ class SegmentsTable(ThreadableDBObject, TableSource):
                     break
 
                 todo_nodes = set()
-                sql = self.src.data.select()\
-                        .where(self.src.c.id.in_(list(additional_ways)))
-                for w in conn.execute(sql):
+                waysql = self.src.data.select()\
+                           .where(self.src.c.id.in_(list(additional_ways)))
+                for w in conn.execute(waysql):
                     prop = tuple((w._mapping[x] for x in self.prop_columns))
                     wayproc.add_way(prop, w.id, w.nodes, w.geom)
                     waysdone.add(w.id)
@@ -193,21 +205,37 @@ class SegmentsTable(ThreadableDBObject, TableSource):
                 if not todo_nodes:
                     break
 
-                conn.execute(Truncate(temp_nodes))
-                conn.execute(temp_nodes.insert(),
-                             [ { "tid" : x } for x in todo_nodes ])
+                log.debug("Nodes needing updating: %s", todo_nodes)
+                sql = sa.select(self.c.id, self.c.ways)\
+                        .where(self.c.nodes.op('&&')(
+                                   sa.bindparam('nodes', type_=ARRAY(sa.BigInteger))))
+                params = {'nodes': list(todo_nodes)}
 
-            # done, add the result back to the table
-            log.info("Processing segments")
             cur_id = conn.scalar(sa.select(saf.max(self.c.id)))
             first_new_id = 0 if cur_id is None else cur_id + 1
 
-            temp_nodes.drop(conn)
-
+        # done, add the result back to the table
+        # (outside the transaction, so that worker processes are not
+        #  forked while a connection is in use)
+        log.info("Processing segments")
+        try:
             wayproc.process_cached_ways()
             wayproc.finish()
-
-            # add all newly created segments to the update table
+        except Exception:
+            # Drop any new segments that made it into the table, so that
+            # the update can simply be retried.
+            with engine.begin() as conn:
+                conn.execute(self.data.delete().where(self.c.id >= first_new_id))
+            raise
+
+        # Remove the replaced segments and add all newly created segments
+        # to the update table. New segments all have ids >= first_new_id.
+        with engine.begin() as conn:
+            if deleted_ids:
+                conn.execute(self.data.delete()
+                               .where(self.c.id == sa.any_(
+                                   sa.literal(list(deleted_ids), ARRAY(sa.BigInteger))))
+                               .where(self.c.id < first_new_id))
             if self.change is not None:
                 self.write_change_table(conn, deleted_ids)
                 conn.execute(self.change.insert().from_select(self.cc,
@@ -225,8 +253,9 @@ class _WayCollector(ThreadableDBObject):
     """
 
     def __init__(self, parent, engine, creation_mode=False,
-                 numthreads=None):
+                 numthreads=None, use_processes=False):
         self.src = parent
+        self.engine = engine
         self.update_mode = not creation_mode
 
         if self.update_mode:
@@ -235,13 +264,16 @@ class _WayCollector(ThreadableDBObject):
             # When in update mode, the intersection points are collected on the
             # fly from the ways to be updated
             self.collected_nodes = Counter()
+        elif getattr(parent, 'count_nodes', False):
+            self._get_intersections_from_stream(engine)
         else:
             # precompute intersections
             self._get_intersections_from_db(engine)
 
-        # the worker threads
-        self.set_num_threads(numthreads)
-        self.workers = self.create_worker_queue(engine, self._process_next)
+        # The worker threads are only started with the first task, so that
+        # worker processes see the final set of intersections.
+        self.set_num_threads(numthreads, use_processes)
+        self.workers = None
 
     @property
     def srid(self):
@@ -278,8 +310,76 @@ class _WayCollector(ThreadableDBObject):
             for ele in c:
                 self.intersections.add(ele.nid)
 
+    def _get_intersections_from_stream(self, engine):
+        """ Find all potential mid-way intersections by counting the
+            node weights while streaming the node lists of the source.
+        """
+        counter = _NodeWeightCounter(spill_dir=getattr(self.src, 'spill_dir', None))
+
+        s = self.src.src.data
+        sql = sa.select(s.c.nodes).execution_options(yield_per=10000)
+        with engine.begin() as conn:
+            for row in conn.execute(sql):
+                counter.add(row.nodes)
+
+        self.intersections = _SortedIds(counter.intersections())
+
     def process_ways(self, properties, ways):
-        self.workers.add_task((properties, ways))
+        if self.workers is None:
+            self.workers = self.create_worker_queue(self.engine, self._process_next)
+
+        task_size = self.src.task_size
+        if task_size and len(ways) > task_size:
+            for part in self._split_ways(ways, task_size):
+                self.workers.add_task((properties, part))
+        else:
+            self.workers.add_task((properties, ways))
+
+    def _split_ways(self, ways, task_size):
+        """ Split a list of ways with identical properties into batches
+            of about `task_size` ways.
+
+            Ways can only be fused at end points that are not intersections.
+            Ways connected through such points are always kept in the same
+            batch, so that the result is the same as processing all ways
+            at once. The parts are sorted by the tile of their first point
+            before they are batched, so that each batch covers a compact area.
+        """
+        parent = list(range(len(ways)))
+
+        def _find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        end_owner = {}
+        for i, (_, nodes, _) in enumerate(ways):
+            for nid in (nodes[0], nodes[-1]):
+                if nid in self.intersections:
+                    continue
+                other = end_owner.setdefault(nid, i)
+                if other != i:
+                    parent[_find(i)] = _find(other)
+
+        parts = {}
+        for i, way in enumerate(ways):
+            parts.setdefault(_find(i), []).append(way)
+
+        tile = 10000.0 if self.srid == 3857 else 0.1
+        def _tile_key(part):
+            x, y = part[0][2][0]
+            return (int(x // tile), int(y // tile))
+
+        batch = []
+        for part in sorted(parts.values(), key=_tile_key):
+            if batch and len(batch) + len(part) > task_size:
+                yield batch
+                batch = []
+            batch.extend(part)
+
+        if batch:
+            yield batch
 
     def process_cached_ways(self):
         # compute intersections from node counts
@@ -320,7 +420,9 @@ class _WayCollector(ThreadableDBObject):
             self.collected_nodes[nodes[-1]] += 1
 
     def finish(self):
-        self.workers.finish()
+        if self.workers is not None:
+            self.workers.finish()
+            self.workers = None
         del self.intersections
 
     def _process_next(self, item):
@@ -332,6 +434,8 @@ class _WayCollector(ThreadableDBObject):
         # add all ways to a temporary list and find potential fuse points
         for osmid, nodes, geom in inways:
             nnodes = len(nodes)
+            nodes = array('q', nodes)
+            geom = np.asarray(geom, dtype=np.float64)
             # find all nodes that are forced intersections inside the line
             splitidx = [x for x in range(1, nnodes - 1)
                          if nodes[x] in self.intersections]
@@ -368,19 +472,156 @@ class _WayCollector(ThreadableDBObject):
         for w in segments:
             self._write_segment(properties, w)
 
+    def _init_worker_thread(self):
+        super()._init_worker_thread()
+        self.thread.writer = BulkInserter(self.thread.conn, self.src.data,
+                                          self.src.copy_batch_size)
+
+    def _shutdown_worker_thread(self):
+        self.thread.writer.flush()
+        super()._shutdown_worker_thread()
+
     def _write_segment(self, props, segment):
-        fields = {'nodes' : segment.nodes,
-                  'ways' : segment.osmids,
-                  'geom' : from_shape(LineString(segment.geom), srid=self.srid)}
+        fields = {'nodes' : segment.nodes.tolist(),
+                  'ways' : sorted(set(segment.osmids)),
+                  'geom' : linestring_ewkb(segment.geom, self.srid)}
         fields.update(dict(zip(self.src.prop_columns, props)))
-        self.thread.conn.execute(self.src.data.insert().values(fields))
+        self.thread.writer.add(fields)
 
 
 
-class _Segment(object):
+class _NodeWeightCounter:
+    """ Sums up the weights of nodes in a set of ways: end points
+        count 1, inner nodes 2. Nodes with a weight larger than 2
+        are intersections.
+
+        Incoming weights are buffered in compact arrays. A full buffer is
+        sorted and then merged into the sorted NumPy arrays of node ids
+        and weights. Weights are capped at 3 to fit into a byte. If
+        `spill_dir` is given, the merged arrays are kept in memory-mapped
+        files in that directory and merged chunk by chunk, so that only
+        the buffer and one chunk of the arrays need to be in memory.
+    """
+
+    def __init__(self, buffer_size=10000000, spill_dir=None):
+        self.buffer_size = buffer_size
+        self.spill_dir = spill_dir
+        self.ids = np.empty(0, dtype=np.int64)
+        self.weights = np.empty(0, dtype=np.uint8)
+        self.buf_ids = array('q')
+        self.buf_weights = array('B')
+
+    def add(self, nodes):
+        """ Add the nodes of the next way.
+        """
+        if not nodes:
+            return
+
+        self.buf_ids.extend(nodes)
+        self.buf_weights.append(1)
+        if len(nodes) > 1:
+            self.buf_weights.extend([2] * (len(nodes) - 2))
+            self.buf_weights.append(1)
+
+        if len(self.buf_ids) >= self.buffer_size:
+            self._merge()
+
+    def intersections(self):
+        """ Return a sorted array of all nodes with a weight larger than 2.
+        """
+        self._merge()
+        return np.array(self.ids[self.weights > 2])
+
+    def _merge(self):
+        if not self.buf_ids:
+            return
+
+        bids, inverse = np.unique(np.frombuffer(self.buf_ids, dtype=np.int64),
+                                  return_inverse=True)
+        bweights = np.bincount(inverse,
+                               weights=np.frombuffer(self.buf_weights, dtype=np.uint8))
+        bweights = np.minimum(bweights, 3).astype(np.uint8)
+        del inverse
+        self.buf_ids = array('q')
+        self.buf_weights = array('B')
+
+        if self.spill_dir is None:
+            self.ids, self.weights = _merge_weights(self.ids, self.weights,
+                                                    bids, bweights)
+            return
+
+        with tempfile.TemporaryFile(dir=self.spill_dir) as id_fd, \
+             tempfile.TemporaryFile(dir=self.spill_dir) as weight_fd:
+            total = 0
+            done = 0
+            for i in range(0, len(self.ids), self.buffer_size):
+                ids = np.array(self.ids[i:i + self.buffer_size])
+                weights = np.array(self.weights[i:i + self.buffer_size])
+                if i + self.buffer_size < len(self.ids):
+                    todo = int(np.searchsorted(bids, ids[-1], side='right'))
+                else:
+                    todo = len(bids)
+                ids, weights = _merge_weights(ids, weights,
+                                              bids[done:todo], bweights[done:todo])
+                id_fd.write(ids.tobytes())
+                weight_fd.write(weights.tobytes())
+                total += len(ids)
+                done = todo
+
+            if done < len(bids):
+                id_fd.write(bids[done:].tobytes())
+                weight_fd.write(bweights[done:].tobytes())
+                total += len(bids) - done
+
+            id_fd.flush()
+            weight_fd.flush()
+            self.ids = np.memmap(id_fd, dtype=np.int64, mode='r', shape=(total, ))
+            self.weights = np.memmap(weight_fd, dtype=np.uint8, mode='r', shape=(total, ))
+
+
+def _merge_weights(ids, weights, new_ids, new_weights):
+    """ Merge the sorted unique node ids `new_ids` with their weights
+        into the sorted arrays `ids` and `weights`. Weights of nodes that
+        appear in both are added up. Returns the merged arrays.
+    """
+    pos = np.searchsorted(ids, new_ids)
+    found = pos < len(ids)
+    found[found] = ids[pos[found]] == new_ids[found]
+
+    weights = weights.copy()
+    weights[pos[found]] = np.minimum(weights[pos[found]] + new_weights[found], 3)
+
+    missing = ~found
+    return (np.insert(ids, pos[missing], new_ids[missing]),
+            np.insert(weights, pos[missing], new_weights[missing]))
+
+
+class _SortedIds:
+    """ Set-like view on a sorted array of node ids. Membership is
+        tested with a binary search.
+    """
+    __slots__ = ('ids', )
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __contains__(self, nid):
+        i = np.searchsorted(self.ids, nid)
+        return i < len(self.ids) and self.ids[i] == nid
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class _Segment:
+    """ A piece of a line with its node ids, coordinates and the ids of
+        the source ways. Node ids and source ids are kept in compact
+        arrays, the coordinates in a NumPy array of shape (n, 2).
+    """
+    __slots__ = ('osmids', 'nodes', 'geom')
 
     def __init__(self, osmid, nodes, geom):
-        self.osmids = set((osmid,))
+        self.osmids = array('q', (osmid, ))
         self.nodes = nodes
         self.geom = geom
 
@@ -411,12 +652,12 @@ class _Segment(object):
             # The way is reversing back on itself, throw away the other part.
             return None
 
-        self.osmids.update(other.osmids)
-        self.nodes.extend(other.nodes[1:])
-        self.geom.extend(other.geom[1:])
+        self.osmids.extend(other.osmids)
+        self.nodes = self.nodes + other.nodes[1:]
+        self.geom = np.concatenate((self.geom, other.geom[1:]))
 
         return other.nodes[-1]
 
     def reverse(self):
-        self.nodes.reverse()
-        self.geom.reverse()
+        self.nodes = self.nodes[::-1]
+        self.geom = self.geom[::-1]
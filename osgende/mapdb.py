@@ -6,6 +6,7 @@
 import logging
 import collections
 import types
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import sqlalchemy as sa
 
@@ -44,6 +45,41 @@ class _Tables:
     def add(self, name, table):
         self._data[name] = table
 
+# Attributes of table objects that point to the tables they are computed from.
+SOURCE_ATTRIBUTES = ('src', 'way_src', 'relation_src', 'osmdata')
+
+def _run_scheduled(jobs, dependencies, func, parallel):
+    """ Call `func` on each of the `jobs` with at most `parallel` calls
+        running concurrently. `dependencies` maps a job to the set of jobs
+        that need to be finished before the job may be started.
+
+        When one of the jobs fails, no further jobs are started and
+        the exception is reraised once the running jobs are finished.
+    """
+    todo = list(jobs)
+    done = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        while todo or running:
+            for job in [j for j in todo if dependencies.get(j, set()) <= done]:
+                if len(running) >= parallel:
+                    break
+                todo.remove(job)
+                running[executor.submit(func, job)] = job
+
+            if not running:
+                raise RuntimeError("Circular dependency between tables.")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                if future.exception() is not None:
+                    wait(running)
+                    raise future.exception()
+                done.add(job)
+
+
 class MapDB:
     """Basic class for creation and modification of a complete database.
 
@@ -51,17 +87,26 @@ class MapDB:
        currently makes use of the following:
 
            * '''nodestore''' - filename of the location for the the node store.
+           * '''nodestore_readonly''' - if set, the node store is memory-mapped
+             in read-only mode. The mapped pages are then shared between
+             processes.
            * '''schema''' - schema associated with this DB. The only effect this
              currently has is that the create action will attempt to create the
              schema.
            * '''ro_user''' - read-only user to grant rights to for all tables. Only
              used for create action.
+           * '''parallel_tables''' - number of tables that may be constructed or
+             updated at the same time. Tables are only processed in parallel
+             when they do not depend on each other. See add_table(). Cannot
+             be used with tables that run their workers in processes. The
+             connection pool of the engine is enlarged as needed.
     """
 
     def __init__(self, options):
         self.options = options
         self.osmdata = OsmSourceTables(sa.MetaData(),
-                                       nodestore=self.get_option('nodestore'))
+                                       nodestore=self.get_option('nodestore'),
+                                       nodestore_readonly=self.get_option('nodestore_readonly', False))
 
         if self.get_option('status', True):
             self.status = StatusManager(sa.MetaData())
@@ -76,14 +121,31 @@ class MapDB:
         self.metadata = sa.MetaData(schema=self.get_option('schema'))
 
         self.tables = _Tables()
+        self.dependencies = {}
 
-    def add_table(self, name, table):
+    def add_table(self, name, table, depends_on=()):
         """ Add a new table handler to the database. The table is available
             as self.table.<name> afterwards and will also be returned.
             Tables must be added in the order they need to be processed to
             ensure that dependencies are available.
+
+            When tables are processed in parallel, a table is only processed
+            after the tables it is derived from. These are found through the
+            usual source attributes of the table (src, way_src etc.).
+            Any additional tables the table depends on, for example because
+            they are used in a subquery, must be given in `depends_on`,
+            either as table objects or by their name.
         """
+        deps = set()
+        for attr in SOURCE_ATTRIBUTES:
+            src = getattr(table, attr, None)
+            if src is not None and any(src is t for t in self.tables):
+                deps.add(src)
+        for dep in depends_on:
+            deps.add(self.tables[dep] if isinstance(dep, str) else dep)
+
         self.tables.add(name, table)
+        self.dependencies[table] = deps
         return table
 
     def set_metadata(self, key, value):
@@ -124,35 +186,67 @@ class MapDB:
                     conn.execute(sa.text(f'GRANT SELECT ON TABLE {table.data.key} TO "{rouser}"'))
 
     def construct(self):
-        for tab in self.tables:
-            LOG.info("Importing %s...", str(tab.data.name))
-            tab.construct(self.engine)
-            if hasattr(tab, 'after_construct'):
-                tab.after_construct(self.engine)
-            with self.engine.begin() as conn:
-                self.status.set_status_from(conn, tab.data.key, 'base')
+        self._process_tables(self._construct_table)
+
+    def _construct_table(self, tab):
+        LOG.info("Importing %s...", str(tab.data.name))
+        tab.construct(self.engine)
+        if hasattr(tab, 'after_construct'):
+            tab.after_construct(self.engine)
+        with self.engine.begin() as conn:
+            self.status.set_status_from(conn, tab.data.key, 'base')
 
     def update(self):
         with self.engine.begin() as conn:
             base_state = self.status.get_sequence(conn)
 
-        for tab in self.tables:
-            if base_state is not None:
-                with self.engine.begin() as conn:
-                    table_state = self.status.get_sequence(conn, tab.data.key)
-                if table_state is not None and table_state >= base_state:
-                    LOG.info("Table %s already up-to-date.", tab)
-                    continue
-
-            if hasattr(tab, 'before_update'):
-                tab.before_update(self.engine)
-            LOG.info("Updating %s...", str(tab.data.name))
-            tab.update(self.engine)
-            if hasattr(tab, 'after_update'):
-                tab.after_update(self.engine)
+        self._process_tables(lambda tab: self._update_table(tab, base_state))
 
+    def _update_table(self, tab, base_state):
+        if base_state is not None:
             with self.engine.begin() as conn:
-                self.status.set_status_from(conn, tab.data.key, 'base')
+                table_state = self.status.get_sequence(conn, tab.data.key)
+            if table_state is not None and table_state >= base_state:
+                LOG.info("Table %s already up-to-date.", tab)
+                return
+
+        if hasattr(tab, 'before_update'):
+            tab.before_update(self.engine)
+        LOG.info("Updating %s...", str(tab.data.name))
+        tab.update(self.engine)
+        if hasattr(tab, 'after_update'):
+            tab.after_update(self.engine)
+
+        with self.engine.begin() as conn:
+            self.status.set_status_from(conn, tab.data.key, 'base')
+
+    def _process_tables(self, func):
+        parallel = self.get_option('parallel_tables', 1) or 1
+        if parallel <= 1:
+            for tab in self.tables:
+                func(tab)
+        else:
+            if any(getattr(tab, 'numthreads', None) and getattr(tab, 'use_processes', False)
+                   for tab in self.tables):
+                raise RuntimeError("Tables with worker processes cannot be"
+                                   " processed in parallel ('parallel_tables').")
+            self._resize_pool(parallel)
+            _run_scheduled(self.tables, self.dependencies, func, parallel)
+
+    def _resize_pool(self, parallel):
+        """ Make sure that the connection pool has enough connections
+            for processing `parallel` tables at once. Each table needs
+            one connection for each worker thread and up to two for
+            reading and writing.
+        """
+        threads = max((getattr(tab, 'numthreads', None) or 0 for tab in self.tables),
+                      default=0)
+        pool_size = parallel * (threads + 2)
+        if pool_size > self.engine.pool.size():
+            LOG.debug("Resizing connection pool to %d.", pool_size)
+            url, echo = self.engine.url, self.engine.echo
+            self.engine.dispose()
+            self.engine = sa.create_engine(url, echo=echo, pool_size=pool_size)
 
     def finalize(self, dovacuum):
         """ Analyse the tables to update the statistics.
@@ -3,11 +3,14 @@
 # This file is part of Osgende
 # Copyright (C) 2015-2022 Sarah Hoffmann
 
-from sqlalchemy import Table, Column, BigInteger, String, select
+from itertools import chain
+
+import numpy as np
+from sqlalchemy import Table, Column, BigInteger, String, select, or_, not_
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 from geoalchemy2 import Geometry
 from osgende.common.table import TableSource
-from osgende.common.nodestore import NodeStore, NodeStorePoint
+from osgende.common.nodestore import NodeStore, NodeStorePoint, ReadOnlyNodeStore
 
 def _mkpointlist_points(nodes, store):
     ret = []
@@ -24,22 +27,57 @@ def _mkpointlist_points(nodes, store):
 
     return ret
 
+def _mkcoords(coords, valid):
+    coords = coords[valid]
+
+    # Consecutive duplicates are moved slightly. As in _mkpointlist_points,
+    # a point is compared with the already moved predecessor.
+    if len(coords) > 1:
+        dups = np.flatnonzero((coords[1:] == coords[:-1]).all(axis=1)) + 1
+        for i in dups:
+            if coords[i, 0] == coords[i - 1, 0] and coords[i, 1] == coords[i - 1, 1]:
+                coords[i, 0] += 0.00000001
+
+    return coords
+
+def _mkcoords_from_dict(nodes, geoms):
+    coords = np.array([geoms.get(n, (np.nan, np.nan)) for n in nodes],
+                      dtype=np.float64).reshape((-1, 2))
+
+    return _mkcoords(coords, ~np.isnan(coords[:, 0]))
+
+def _mkpointlist_coords(coords, valid):
+    return [NodeStorePoint(x, y) for x, y in _mkcoords(coords, valid).tolist()]
+
 class OsmSourceTables:
     """Collection of table sources that point to raw OSM data.
+
+       The node locations for a list of node ids can be retrieved with
+       get_points(), which returns a list of NodeStorePoints, or with
+       get_coords(), which returns a NumPy array of shape (n, 2). Nodes
+       that are unknown are skipped in both cases. get_coords_many() takes
+       a list of node lists and looks up all of them at once.
     """
 
-    def __init__(self, meta, nodestore=None):
+    def __init__(self, meta, nodestore=None, nodestore_readonly=False):
         self.node = self.create_node_table(meta)
         self.way = self.create_way_table(meta)
         self.relation = self.create_relation_table(meta)
 
         if nodestore is None:
             self.get_points = self.__table_get_points
+            self.get_coords = self.__table_get_coords
+            self.get_coords_many = self.__table_get_coords_many
             self.nodestore = None
         else:
             self.get_points = self.__nodestore_get_points
+            self.get_coords = self.__nodestore_get_coords
+            self.get_coords_many = self.__nodestore_get_coords_many
             if isinstance(nodestore, str):
-                self.nodestore = NodeStore(nodestore)
+                if nodestore_readonly:
+                    self.nodestore = ReadOnlyNodeStore(nodestore)
+                else:
+                    self.nodestore = NodeStore(nodestore)
             else:
                 self.nodestore = nodestore
 
@@ -48,6 +86,8 @@ class OsmSourceTables:
         """ Create the table source for backing OSM node data.
             Node tables are special because they have a change table that
             also stores tags and geometry of changed nodes to avoid lookup.
+            The change table further records the location of the node
+            before the change in 'old_geom' (NULL for new nodes).
         """
         data = Table('nodes', meta,
                      Column('id', BigInteger),
@@ -58,7 +98,9 @@ class OsmSourceTables:
                        Column('id', BigInteger),
                        Column('action', String(1)),
                        Column('tags', JSONB),
-                       Column('geom', Geometry('POINT', srid=4326))
+                       Column('geom', Geometry('POINT', srid=4326)),
+                       Column('old_geom', Geometry('POINT', srid=4326,
+                                                   spatial_index=False))
                       )
         return TableSource(data, change)
 
@@ -85,10 +127,32 @@ class OsmSourceTables:
     def __getitem__(self, key):
         return getattr(self, key)
 
+    def node_moved(self):
+        """ Return an SQL expression over the node change table that is
+            true for all nodes whose location may have changed: added and
+            deleted nodes as well as nodes that have been moved.
+        """
+        nc = self.node.cc
+        return or_(nc.action == 'D', nc.old_geom.is_(None), nc.geom.is_(None),
+                   not_(nc.geom.ST_Equals(nc.old_geom)))
+
     def __nodestore_get_points(self, nodes, engine=None):
-        return _mkpointlist_points(nodes, self.nodestore)
+        return _mkpointlist_coords(*self.nodestore.get_many(nodes))
 
-    def __table_get_points(self, nodes, conn):
+    def __nodestore_get_coords(self, nodes, engine=None):
+        return _mkcoords(*self.nodestore.get_many(nodes))
+
+    def __nodestore_get_coords_many(self, node_lists, engine=None):
+        if not node_lists:
+            return []
+
+        coords, valid = self.nodestore.get_many(list(chain.from_iterable(node_lists)))
+        splits = np.cumsum([len(nodes) for nodes in node_lists[:-1]])
+
+        return [_mkcoords(c, v) for c, v in zip(np.split(coords, splits),
+                                                np.split(valid, splits))]
+
+    def __table_get_node_locations(self, nodes, conn):
         t = self.node.data
         sql = select(t.c.id, t.c.geom.ST_X().label('x'),
                      t.c.geom.ST_Y().label('y')).where(t.c.id.in_(nodes))
@@ -97,4 +161,16 @@ class OsmSourceTables:
         for res in conn.execute(sql):
             geoms[res.id] = NodeStorePoint(res.x, res.y)
 
-        return _mkpointlist_points(nodes, geoms)
+        return geoms
+
+    def __table_get_points(self, nodes, conn):
+        return _mkpointlist_points(nodes, self.__table_get_node_locations(nodes, conn))
+
+    def __table_get_coords(self, nodes, conn):
+        return _mkcoords_from_dict(nodes, self.__table_get_node_locations(nodes, conn))
+
+    def __table_get_coords_many(self, node_lists, conn):
+        geoms = self.__table_get_node_locations(
+                    list(set(chain.from_iterable(node_lists))), conn)
+
+        return [_mkcoords_from_dict(nodes, geoms) for nodes in node_lists]
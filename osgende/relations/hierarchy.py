@@ -4,7 +4,7 @@
 # Copyright (C) 2022 Sarah Hoffmann
 
 import sqlalchemy as sa
-from sqlalchemy.dialects.postgresql import array
+from sqlalchemy.dialects.postgresql import array, ARRAY
 from sqlalchemy.dialects.postgresql import JSONB
 
 from osgende.common.sqlalchemy import Truncate
@@ -20,9 +20,13 @@ class RelationHierarchy:
 
        If `self_ref` is True, then each relation is added as its own child
        with depth = 1.
+
+       Direct children have depth 2. Children further down are followed
+       up to a depth of `max_depth`. Circular references are detected and
+       each parent/child pair appears only once with its smallest depth.
     """
 
-    def __init__(self, meta, name, source, self_ref=False):
+    def __init__(self, meta, name, source, self_ref=False, max_depth=5):
         self.data = sa.Table(name, meta,
                              sa.Column('parent', sa.BigInteger, index=True),
                              sa.Column('child', sa.BigInteger, index=True),
@@ -31,6 +35,7 @@ class RelationHierarchy:
 
         self.src = source
         self.self_reference = self_ref
+        self.max_depth = max_depth
 
     @property
     def c(self):
@@ -45,42 +50,61 @@ class RelationHierarchy:
     def create(self, engine):
         self.data.create(bind=engine, checkfirst=True)
 
+    def _select_hierarchy(self, parents=None):
+        """ Return a query for the (parent, child, depth) rows of the
+            hierarchy. The query is computed with a recursive CTE which
+            keeps track of the path to detect cycles. If `parents` is
+            given, it must be a query with relation ids and only the
+            hierarchy below these relations is computed. The members of
+            each relation are expanded only when the recursion reaches it.
+        """
+        rels = self.src.data.alias('r')
+        members, child = self._relation_members(rels)
+
+        start = sa.select(rels.c.id.label('parent'), child.label('child'),
+                          sa.literal(2).label('depth'),
+                          array([rels.c.id, child]).label('path'))\
+                  .select_from(rels.join(members, onclause=sa.text("True")))\
+                  .where(members.c.value['type'].astext == 'R')\
+                  .where(child != rels.c.id)\
+                  .distinct()
+        if parents is not None:
+            start = start.where(rels.c.id.in_(parents))
+        tree = start.cte('tree', recursive=True)
+
+        prev = tree.alias('prev')
+        subrels = self.src.data.alias('sub')
+        members, child = self._relation_members(subrels)
+        tree = tree.union_all(
+                 sa.select(prev.c.parent, child, prev.c.depth + 1,
+                           sa.func.array_append(prev.c.path, child))
+                   .select_from(prev.join(subrels, subrels.c.id == prev.c.child)
+                                    .join(members, onclause=sa.text("True")))
+                   .where(members.c.value['type'].astext == 'R')
+                   .where(child != sa.all_(prev.c.path))
+                   .where(prev.c.depth < self.max_depth))
+
+        return sa.select(tree.c.parent, tree.c.child, sa.func.min(tree.c.depth))\
+                 .group_by(tree.c.parent, tree.c.child)
+
+    @staticmethod
+    def _relation_members(rels):
+        """ Return a lateral table of the members of the relations in
+            `rels` together with the member id as a BIGINT expression.
+        """
+        members = sa.func.jsonb_array_elements(rels.c.members)\
+                         .table_valued(sa.column('value', JSONB)).lateral()
+
+        return members, members.c.value['id'].astext.cast(sa.BigInteger)
+
     def construct(self, engine):
         """Fill the table from the current relation table.
         """
         with engine.begin() as conn:
             self.truncate(conn)
-            # Insert all direct children
-            rels = self.src.data.alias('r')
-            members = sa.func.jsonb_array_elements(rels.c.members)\
-                             .table_valued(sa.column('value', JSONB)).lateral()
-            id_bigint = members.c.value['id'].astext.cast(sa.BigInteger)
-
-            sql = sa.select(rels.c.id.label('parent'), id_bigint.label('child'), 2)\
-                    .select_from(rels.join(members, onclause=sa.text("True")))\
-                    .where(members.c.value['type'].astext == 'R')\
-                    .where(id_bigint != rels.c.id.label('parent'))
-            # XXX adding 'returning' here because otherwise SQLAlchemy/psycopg3
-            # refuses to give us a rowcount,
-            # see https://github.com/sqlalchemy/sqlalchemy/issues/10974
-            res = conn.execute(self.data.insert().from_select(self.data.c, sql)
-                                                 .returning(self.data.c.parent))
-
-            level = 3
-            while res.rowcount > 0 and level < 6:
-                pd = self.data.alias()
-                prev = sa.select(pd.c.parent, pd.c.child).where(pd.c.depth == (level - 1)).alias()
-                nd = self.data.alias()
-                newly = sa.select(nd.c.parent, nd.c.child).where(nd.c.depth == 2).alias()
-                old = self.data.alias()
-                subs = sa.select(prev.c.parent, newly.c.child, level)\
-                        .where(prev.c.child == newly.c.parent)\
-                        .where(prev.c.parent != newly.c.child)\
-                        .except_(sa.select(old.c.parent, old.c.child, level))
-
-                res = conn.execute(self.data.insert().from_select(self.data.c, subs)
-                                                     .returning(self.data.c.parent))
-                level = level + 1
+
+            conn.execute(self.data.insert().from_select(self.data.c,
+                                                        self._select_hierarchy()))
 
             # Finally add all relations themselves.
             if self.self_reference:
@@ -91,6 +115,32 @@ class RelationHierarchy:
     def update(self, engine):
         """Update the table.
 
-           The table is actually simply reconstructed because that is faster.
+           Only the hierarchies below changed relations and their
+           former parents are recomputed.
         """
-        self.construct(engine)
+        if self.src.change is None:
+            self.construct(engine)
+            return
+
+        with engine.begin() as conn:
+            changed = sa.select(self.src.cc.id)
+            affected = sa.union(changed,
+                                sa.select(self.c.parent)
+                                  .where(self.c.child.in_(changed)))
+            affected = set(conn.scalars(affected))
+            if not affected:
+                return
+
+            affected_ids = sa.literal(list(affected), ARRAY(sa.BigInteger))
+            conn.execute(self.data.delete()
+                           .where(self.c.parent == sa.any_(affected_ids)))
+
+            parents = sa.select(sa.func.unnest(affected_ids))
+            conn.execute(self.data.insert().from_select(
+                           self.data.c, self._select_hierarchy(parents)))
+
+            if self.self_reference:
+                s = self.src.data
+                conn.execute(self.data.insert().from_select(self.data.c,
+                    sa.select(s.c.id.label('parent'), s.c.id.label('child'), 1)
+                      .where(s.c.id == sa.any_(affected_ids))))
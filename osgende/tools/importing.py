@@ -5,9 +5,13 @@
 """
 Create/update OSM source tables from an OSM file.
 """
+import logging
 from binascii import hexlify
 import struct
+from pathlib import Path
+from urllib import request as urlrequest
 from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 
 from psycopg.adapt import Dumper
 from psycopg.types.json import Jsonb
@@ -16,26 +20,47 @@ import sqlalchemy as sa
 from sqlalchemy.dialects.postgresql import insert
 import osmium
 
+from osgende.common.bulk import binary_copy_types
 from osgende.common.nodestore import NodeStore
+from osgende.common.sqlalchemy import Analyse
 from osgende.common.sqlalchemy.database import database_create
 from osgende.osmdata import OsmSourceTables
 from osgende.common.status import StatusManager
+from osgende.common.threads import WorkerQueue, WorkerError
 from osmium.replication.server import ReplicationServer
 
+log = logging.getLogger(__name__)
+
 def obj2action(obj):
     if obj.visible:
         return 'C' if obj.version == 1 else 'M'
     else:
         return 'D' # delete
 
-def loc2wkb(loc):
+def members2json(rel):
+    return [{'id': m.ref, 'role': m.role, 'type': m.type.upper()} for m in rel.members]
+
+def loc2ewkb(loc):
     # PostGIS extension that includes a SRID, see postgis/doc/ZMSGeoms.txt
-    return hexlify(struct.pack("=biidd", 1, 0x20000001, 4326,
-                               loc.lon, loc.lat)).decode()
+    return struct.pack("=biidd", 1, 0x20000001, 4326, loc.lon, loc.lat)
 
-def copy_to(conn, sql):
+def loc2wkb(loc):
+    return hexlify(loc2ewkb(loc)).decode()
+
+def nodestore_wkb(nodestore, osmid):
+    """ Return the location of the given node in the node store as
+        hex-encoded EWKB or None if the node is not known.
+    """
+    try:
+        return nodestore[osmid].wkb()
+    except KeyError:
+        return None
+
+def copy_to(conn, sql, types=None):
     with conn.cursor() as cur:
         with cur.copy(sql) as copy:
+            if types is not None:
+                copy.set_types(types)
             while True:
                 try:
                     row = (yield None)
@@ -44,70 +69,243 @@ def copy_to(conn, sql):
                     break
 
 
-COPY_SQL = {
-    'N': 'COPY nodes(id, tags, geom) FROM stdin',
-    'W': 'COPY ways(id, tags, nodes) FROM stdin',
-    'R': 'COPY relations(id, tags, members) FROM stdin'
+def open_copy(conn, spec, binary=False):
+    """ Start a new COPY on the given psycopg connection. Without `binary`,
+        `spec` is the SQL for the COPY in text format. With `binary`,
+        `spec` is a tuple of table name and list of columns and
+        a binary COPY is started.
+    """
+    if binary:
+        table, columns = spec
+        sql = f"COPY {table}({', '.join(columns)}) FROM stdin (FORMAT BINARY)"
+        writer = copy_to(conn, sql, binary_copy_types(conn, table, columns))
+    else:
+        writer = copy_to(conn, spec)
+    next(writer)
+
+    return writer
+
+
+COPY_TABLES = {
+    'N': ('nodes', ('id', 'tags', 'geom')),
+    'W': ('ways', ('id', 'tags', 'nodes')),
+    'R': ('relations', ('id', 'tags', 'members'))
 }
 
 COPY_CHANGE_SQL = {
-    'N': 'COPY node_changeset(id, action, tags, geom) FROM stdin',
+    'N': 'COPY node_changeset(id, action, tags, geom, old_geom) FROM stdin',
     'W': 'COPY way_changeset(id, action) FROM stdin',
     'R': 'COPY relation_changeset(id, action) FROM stdin'
 }
 
+STAGING_TABLES = {
+    'N': ('nodes', ('tags', 'geom')),
+    'W': ('ways', ('tags', 'nodes')),
+    'R': ('relations', ('tags', 'members'))
+}
+
+COPY_STAGING_SQL = {k: f"COPY {v[0]}_staging(deleted, id, {', '.join(v[1])}) FROM stdin"
+                    for k, v in STAGING_TABLES.items()}
+# Node changes are staged as well, see BatchUpdateHandler.
+COPY_STAGING_SQL['N'] = \
+    "COPY nodes_staging(deleted, id, tags, geom, action, old_geom) FROM stdin"
+
+BULK_LOAD_SETTINGS = {
+    'maintenance_work_mem': '2GB',
+    'max_parallel_maintenance_workers': '4'
+}
+
 class CopyWriter:
+    """ Writes rows through COPY into different tables. `sql` maps the
+        row type to the COPY spec as expected by open_copy().
+    """
 
-    def __init__(self, engine, sql):
+    def __init__(self, engine, sql, binary=False):
         self.sql = sql
+        self.binary = binary
         self.conn = engine.raw_connection()
         self.current_writer = None
         self.copy = None
 
-    def close(self):
+    def flush(self):
+        """ Finish the currently open COPY stream and commit.
+        """
         if self.copy is not None:
             self.copy.close()
+            self.copy = None
+            self.current_writer = None
+        self.conn.commit()
+
+    def close(self):
         if self.conn is not None:
-            self.conn.commit()
+            self.flush()
             self.conn.close()
+            self.conn = None
 
     def write(self, what, *attrs):
         if what != self.current_writer:
             if self.copy is not None:
                 self.copy.close()
             self.conn.commit()
-            self.copy = copy_to(self.conn, self.sql[what])
-            next(self.copy)
+            self.copy = open_copy(self.conn, self.sql[what], self.binary)
             self.current_writer = what
 
         self.copy.send(attrs)
 
 
-class ImportHandler:
+class _CopyStream:
+    """ A single COPY stream that is written by its own worker thread
+        on its own connection. Rows are handed over in batches of
+        `batch_size`.
+    """
+
+    def __init__(self, engine, sql, batch_size, binary=False):
+        self.engine = engine
+        self.sql = sql
+        self.binary = binary
+        self.batch_size = batch_size
+        self.rows = []
+        self.conn = None
+        self.copy = None
+        self.done = False
+        self.worker = WorkerQueue(self._write_rows, 1, self._start, self._finish)
+
+    def _start(self):
+        try:
+            self.conn = self.engine.raw_connection()
+            self.copy = open_copy(self.conn, self.sql, self.binary)
+        except Exception:
+            log.exception("Cannot start COPY stream.")
+            self._abort()
+
+    def _abort(self):
+        """ Give up on the stream after an error. The worker stays alive
+            and drops all further rows, so that close() does not block.
+        """
+        if self.conn is not None:
+            self.conn.rollback()
+            self.conn.close()
+            self.conn = None
+
+    def _write_rows(self, rows):
+        if self.conn is None:
+            return
+        try:
+            for row in rows:
+                self.copy.send(row)
+        except Exception:
+            log.exception("COPY stream failed.")
+            self._abort()
+
+    def _finish(self):
+        if self.conn is not None:
+            self.copy.close()
+            self.conn.commit()
+            self.conn.close()
+            self.done = True
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.worker.add_task(self.rows)
+            self.rows = []
+
+    def close(self):
+        if self.rows:
+            self.worker.add_task(self.rows)
+            self.rows = []
+        self.worker.finish()
+        if not self.done:
+            raise WorkerError("COPY into database failed.")
+
+
+class ParallelCopyWriter:
+    """ Drop-in replacement for the CopyWriter that keeps a separate
+        COPY stream for each object type, so that the streams never need
+        to be switched. Each type may further be split over `num_streams`
+        streams. Objects are distributed over them by blocks of
+        consecutive ids.
+    """
+
+    ID_BLOCK_SHIFT = 16
+
+    def __init__(self, engine, sql, num_streams=1, batch_size=10000, binary=False):
+        self.streams = {what: [_CopyStream(engine, s, batch_size, binary)
+                               for _ in range(num_streams)]
+                        for what, s in sql.items()}
 
-    def __init__(self, engine):
-        self.copy = CopyWriter(engine, COPY_SQL)
+    def close(self):
+        errors = []
+        for streams in self.streams.values():
+            for stream in streams:
+                try:
+                    stream.close()
+                except WorkerError as err:
+                    errors.append(err)
+
+        if errors:
+            raise errors[0]
+
+    def write(self, what, *attrs):
+        streams = self.streams[what]
+        streams[(attrs[0] >> self.ID_BLOCK_SHIFT) % len(streams)].write(attrs)
+
+
+class ImportHandler:
+    """ Handler for loading a full OSM file into empty tables. The data is
+        sent with binary COPY.
+
+        With `num_streams` set, the data is copied into the database in
+        parallel from background threads using `num_streams` connections
+        per object type. Otherwise a single connection is used.
+    """
+
+    def __init__(self, engine, num_streams=0):
+        if num_streams:
+            self.copy = ParallelCopyWriter(engine, COPY_TABLES, num_streams,
+                                           binary=True)
+        else:
+            self.copy = CopyWriter(engine, COPY_TABLES, binary=True)
 
     def close(self):
         self.copy.close()
 
     def node(self, node):
-        self.copy.write('N', node.id, Jsonb(dict(node.tags)),
-                        loc2wkb(node.location))
+        self.copy.write('N', node.id, dict(node.tags), loc2ewkb(node.location))
 
     def way(self, way):
-        self.copy.write('W', way.id, Jsonb(dict(way.tags)),
-                        [n.ref for n in way.nodes])
+        self.copy.write('W', way.id, dict(way.tags), [n.ref for n in way.nodes])
 
     def relation(self, rel):
-        self.copy.write('R', rel.id, Jsonb(dict(rel.tags)),
-                    Jsonb([{'id': m.ref, 'role': m.role, 'type': m.type.upper()} for m in rel.members]))
+        self.copy.write('R', rel.id, dict(rel.tags), members2json(rel))
+
+
+def update_sql(table, osmid, deleted, **values):
+    """ Return the SQL statement that deletes the OSM object with the
+        given id from `table` or inserts or replaces it with the given
+        column values.
+    """
+    if deleted:
+        return table.delete().where(table.c.id == osmid)
+
+    return insert(table).values(id=osmid, **values)\
+                        .on_conflict_do_update(index_elements=[table.c.id],
+                                  set_={k: sa.text('EXCLUDED.' + k) for k in values})
 
 
 class UpdateHandler:
+    """ Handler for change files that writes each object directly into
+        the OSM data tables.
+
+        The previous location of changed nodes is recorded in the node
+        change table. It is taken from `nodestore`, if given, otherwise
+        from the node table. When a node store is used, the handler must
+        see the nodes before the node store is updated.
+    """
 
-    def __init__(self, engine, tables, keep_empty_nodes):
+    def __init__(self, engine, tables, keep_empty_nodes, nodestore=None):
         self.keep_empty_nodes = keep_empty_nodes
+        self.nodestore = nodestore
         self.copy_change = CopyWriter(engine, COPY_CHANGE_SQL)
         self.conn = engine.connect()
         self.ntab = tables.node.data
@@ -122,61 +320,294 @@ class UpdateHandler:
     def node(self, node):
         tags = dict(node.tags)
         geom = loc2wkb(node.location)
-        self.copy_change.write('N', node.id, obj2action(node), Jsonb(tags), geom)
-
-        if node.deleted or (not self.keep_empty_nodes and not node.tags):
-            sql = self.ntab.delete().where(self.ntab.c.id == node.id)
+        sql = update_sql(self.ntab, node.id,
+                         node.deleted or (not self.keep_empty_nodes and not node.tags),
+                         tags=tags, geom=geom)
+        if self.nodestore is None:
+            # All parts of the statement see the table before the change,
+            # so that the old location comes back with the same round-trip.
+            old = sa.select(sa.cast(self.ntab.c.geom, sa.Text).label('geom'))\
+                    .where(self.ntab.c.id == node.id).cte('old_node')
+            old_geom = self.conn.scalar(sa.select(old.c.geom)
+                                          .add_cte(sql.cte('new_node')))
         else:
-            sql = insert(self.ntab)\
-                      .values(id=node.id, tags=tags, geom=geom)\
-                      .on_conflict_do_update(index_elements=[self.ntab.c.id],
-                                          set_={'tags': sa.text('EXCLUDED.tags'),
-                                                'geom': sa.text('EXCLUDED.geom')})
-        self.conn.execute(sql)
+            old_geom = nodestore_wkb(self.nodestore, node.id)
+            self.conn.execute(sql)
+
+        self.copy_change.write('N', node.id, obj2action(node), Jsonb(tags),
+                               geom, old_geom)
 
     def way(self, way):
         self.copy_change.write('W', way.id, obj2action(way))
+        self.conn.execute(update_sql(self.wtab, way.id, way.deleted,
+                                     tags=dict(way.tags),
+                                     nodes=[n.ref for n in way.nodes]))
+
+    def relation(self, rel):
+        self.copy_change.write('R', rel.id, obj2action(rel))
+        self.conn.execute(update_sql(self.rtab, rel.id, rel.deleted,
+                                     tags=dict(rel.tags), members=members2json(rel)))
+
+
+class _UpdateStream:
+    """ Applies the changes for objects of one type from a worker thread
+        on its own connection and in its own transaction. Changes are
+        handed over in batches of `batch_size`.
+
+        If `locate_nodes` is set, the previous locations of nodes are
+        looked up in the node table for each batch.
+    """
+
+    def __init__(self, engine, what, table, batch_size, locate_nodes=False):
+        self.engine = engine
+        self.what = what
+        self.table = table
+        self.batch_size = batch_size
+        self.locate_nodes = locate_nodes
+        self.rows = []
+        self.conn = None
+        self.done = False
+        self.worker = WorkerQueue(self._apply_rows, 1, self._start, self._finish)
+
+    def _start(self):
+        try:
+            self.conn = self.engine.connect()
+        except Exception:
+            log.exception("Cannot connect update stream.")
+
+    def _apply_rows(self, rows):
+        if self.conn is None:
+            return
+        try:
+            self._write_changes(rows)
+        except Exception:
+            # Drop the remaining changes but keep the worker alive,
+            # so that close() does not block.
+            log.exception("Applying changes failed.")
+            self.conn.rollback()
+            self.conn.close()
+            self.conn = None
+
+    def _write_changes(self, rows):
+        changes = [r[0] for r in rows]
+        if self.locate_nodes:
+            t = self.table
+            sql = sa.select(t.c.id, sa.cast(t.c.geom, sa.Text))\
+                    .where(t.c.id.in_([c[0] for c in changes]))
+            old_geoms = dict(self.conn.execute(sql).all())
+            changes = [c[:-1] + (old_geoms.get(c[0]), ) for c in changes]
+
+        with self.conn.connection.driver_connection.cursor() as cur:
+            with cur.copy(COPY_CHANGE_SQL[self.what]) as copy:
+                for row in changes:
+                    copy.write_row(row)
+
+        for change, deleted, values in rows:
+            self.conn.execute(update_sql(self.table, change[0], deleted, **values))
+
+    def _finish(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.done = True
+
+    def write(self, change, deleted, values):
+        self.rows.append((change, deleted, values))
+        if len(self.rows) >= self.batch_size:
+            self.worker.add_task(self.rows)
+            self.rows = []
+
+    def close(self):
+        if self.rows:
+            self.worker.add_task(self.rows)
+            self.rows = []
+        self.worker.finish()
+        if not self.done:
+            raise WorkerError("Applying changes to the database failed.")
+
+
+class ParallelUpdateHandler:
+    """ Handler for change files that applies the changes to nodes, ways
+        and relations in parallel, each type on its own connections and
+        in its own transactions. Each type may further be split over
+        `num_streams` connections. Objects are then distributed over them
+        by blocks of consecutive ids, like in the ParallelCopyWriter.
+
+        All changes are committed by the time close() returns. If one
+        of the connections fails, the others still commit their part of
+        the changes. Reapply the change file in that case.
+
+        Previous node locations are recorded as for the UpdateHandler.
+    """
+
+    def __init__(self, engine, tables, keep_empty_nodes, nodestore=None,
+                 num_streams=1, batch_size=1000):
+        self.keep_empty_nodes = keep_empty_nodes
+        self.nodestore = nodestore
+        self.streams = {
+            'N': [_UpdateStream(engine, 'N', tables.node.data, batch_size,
+                                locate_nodes=nodestore is None)
+                  for _ in range(num_streams)],
+            'W': [_UpdateStream(engine, 'W', tables.way.data, batch_size)
+                  for _ in range(num_streams)],
+            'R': [_UpdateStream(engine, 'R', tables.relation.data, batch_size)
+                  for _ in range(num_streams)]
+        }
+
+    def close(self):
+        errors = []
+        for streams in self.streams.values():
+            for stream in streams:
+                try:
+                    stream.close()
+                except WorkerError as err:
+                    errors.append(err)
+
+        if errors:
+            raise errors[0]
+
+    def _write(self, what, change, deleted, **values):
+        streams = self.streams[what]
+        streams[(change[0] >> ParallelCopyWriter.ID_BLOCK_SHIFT) % len(streams)]\
+            .write(change, deleted, values)
+
+    def node(self, node):
+        tags = dict(node.tags)
+        geom = loc2wkb(node.location)
+        old_geom = None if self.nodestore is None\
+                   else nodestore_wkb(self.nodestore, node.id)
+        self._write('N', (node.id, obj2action(node), Jsonb(tags), geom, old_geom),
+                    node.deleted or (not self.keep_empty_nodes and not node.tags),
+                    tags=tags, geom=geom)
 
-        if way.deleted:
-            sql = self.wtab.delete().where(self.wtab.c.id == way.id)
+    def way(self, way):
+        self._write('W', (way.id, obj2action(way)), way.deleted,
+                    tags=dict(way.tags), nodes=[n.ref for n in way.nodes])
+
+    def relation(self, rel):
+        self._write('R', (rel.id, obj2action(rel)), rel.deleted,
+                    tags=dict(rel.tags), members=members2json(rel))
+
+
+class BatchUpdateHandler:
+    """ Handler for change files that first collects all changed objects
+        in temporary staging tables. When the handler is closed, the
+        changes are applied with one DELETE and one INSERT per object type.
+
+        If an object appears multiple times, the last version wins.
+
+        The location of changed nodes before the change is recorded in the
+        node change table. It is taken from `nodestore`, if given, or
+        otherwise filled in from the node table when the handler is closed.
+        To that end, the node changes go through the staging table and
+        are only added to the node change table on close.
+    """
+
+    def __init__(self, engine, tables, keep_empty_nodes, nodestore=None):
+        self.keep_empty_nodes = keep_empty_nodes
+        self.nodestore = nodestore
+        self.copy_change = CopyWriter(engine, COPY_CHANGE_SQL)
+        self.copy_staging = CopyWriter(engine, COPY_STAGING_SQL)
+
+        with self.copy_staging.conn.cursor() as cur:
+            for table, _ in STAGING_TABLES.values():
+                cur.execute(f"""CREATE TEMPORARY TABLE {table}_staging
+                                (seq BIGSERIAL, deleted BOOLEAN, LIKE {table})""")
+            cur.execute("""ALTER TABLE nodes_staging
+                             ADD COLUMN action TEXT,
+                             ADD COLUMN old_geom geometry(Point, 4326)""")
+
+    def close(self):
+        self.copy_change.close()
+
+        self.copy_staging.flush()
+        with self.copy_staging.conn.cursor() as cur:
+            self._write_node_changes(cur)
+            for table, columns in STAGING_TABLES.values():
+                self._apply_staging(cur, table, columns)
+        self.copy_staging.close()
+
+    def _write_node_changes(self, cur):
+        """ Add the staged nodes to the node change table. Must be called
+            before the node table is updated.
+        """
+        if self.nodestore is None:
+            cur.execute("""INSERT INTO node_changeset (id, action, tags, geom, old_geom)
+                             SELECT s.id, s.action, s.tags, s.geom, n.geom
+                               FROM nodes_staging s LEFT JOIN nodes n ON n.id = s.id""")
         else:
-            sql = insert(self.wtab)\
-                      .values(id=way.id, tags=dict(way.tags),
-                              nodes=[n.ref for n in way.nodes])\
-                      .on_conflict_do_update(index_elements=[self.wtab.c.id],
-                                          set_={'tags': sa.text('EXCLUDED.tags'),
-                                                'nodes': sa.text('EXCLUDED.nodes')})
-        self.conn.execute(sql)
+            cur.execute("""INSERT INTO node_changeset (id, action, tags, geom, old_geom)
+                             SELECT id, action, tags, geom, old_geom FROM nodes_staging""")
+
+    @staticmethod
+    def _apply_staging(cur, table, columns):
+        latest = f"""(SELECT DISTINCT ON (id) * FROM {table}_staging
+                      ORDER BY id, seq DESC) s"""
+        cur.execute(f"""DELETE FROM {table} t USING {latest}
+                        WHERE t.id = s.id and s.deleted""")
+        cur.execute(f"""INSERT INTO {table} (id, {', '.join(columns)})
+                          SELECT id, {', '.join(columns)} FROM {latest}
+                           WHERE not s.deleted
+                        ON CONFLICT (id) DO UPDATE
+                          SET {', '.join(f'{c} = EXCLUDED.{c}' for c in columns)}""")
+        cur.execute(f"DROP TABLE {table}_staging")
+
+    def node(self, node):
+        tags = Jsonb(dict(node.tags))
+        geom = loc2wkb(node.location)
+        old_geom = None if self.nodestore is None\
+                   else nodestore_wkb(self.nodestore, node.id)
 
+        deleted = node.deleted or (not self.keep_empty_nodes and not node.tags)
+        self.copy_staging.write('N', deleted, node.id, tags, geom,
+                                obj2action(node), old_geom)
+
+    def way(self, way):
+        self.copy_change.write('W', way.id, obj2action(way))
+        self.copy_staging.write('W', way.deleted, way.id, Jsonb(dict(way.tags)),
+                                [n.ref for n in way.nodes])
 
     def relation(self, rel):
         self.copy_change.write('R', rel.id, obj2action(rel))
+        self.copy_staging.write('R', rel.deleted, rel.id, Jsonb(dict(rel.tags)),
+                                Jsonb(members2json(rel)))
 
-        if rel.deleted:
-            sql = self.rtab.delete().where(self.rtab.c.id == rel.id)
-        else:
-            sql = insert(self.rtab)\
-                      .values(id=rel.id, tags=dict(rel.tags),
-                              members=[{'id': m.ref, 'role': m.role, 'type': m.type.upper()}
-                                              for m in rel.members])\
-                      .on_conflict_do_update(index_elements=[self.rtab.c.id],
-                                          set_={'tags': sa.text('EXCLUDED.tags'),
-                                                'members': sa.text('EXCLUDED.members')})
-        self.conn.execute(sql)
+
+class LocalReplicationServer(ReplicationServer):
+    """ Replication source that reads the diffs from a local directory
+        instead of downloading them. The directory needs to have the same
+        layout as a replication server: a state.txt with the current
+        state and the diffs with their state files in the usual
+        000/000/001.osc.gz scheme. `url` may be a plain path or
+        a file:// URL.
+    """
+
+    def __init__(self, url, diff_type='osc.gz'):
+        if not url.startswith('file:'):
+            url = Path(url).resolve().as_uri()
+        super().__init__(url, diff_type)
+
+    def open_url(self, url):
+        return urlrequest.urlopen(url)
 
 
 class BaseImportManager:
 
     def __init__(self, dbname, verbose=False):
         self.dbname = dbname
-        dburl = sa.engine.url.URL.create('postgresql+psycopg', database=dbname)
-        self.engine = sa.create_engine(dburl, echo=verbose)
+        self.dburl = sa.engine.url.URL.create('postgresql+psycopg', database=dbname)
+        self.verbose = verbose
+        self.engine = sa.create_engine(self.dburl, echo=verbose)
 
         self.metadata = sa.MetaData()
         self.tables = OsmSourceTables(self.metadata)
         self.replication = None
         self.status = None
         self.nodestore = None
+        self.batch_updates = False
+        self.import_streams = 0
+        self.update_streams = 0
+        self.bulk_load = None
 
     def close(self):
         if self.nodestore is not None:
@@ -194,13 +625,68 @@ class BaseImportManager:
 
 
     def set_replication_source(self, url):
-        self.replication = ReplicationServer(url)
+        """ Set the source for replication diffs. `url` may point to
+            a replication server or to a local directory (see
+            LocalReplicationServer).
+        """
+        if url.startswith('file:') or Path(url).is_dir():
+            self.replication = LocalReplicationServer(url)
+        else:
+            self.replication = ReplicationServer(url)
         self.status = StatusManager(self.metadata)
 
     def set_nodestore(self, filename):
         assert filename
         self.nodestore = NodeStore(filename)
 
+    def set_batch_updates(self, enable=True):
+        """ Apply change files in bulk through staging tables instead of
+            writing each object individually.
+        """
+        self.batch_updates = enable
+
+    def set_import_streams(self, num):
+        """ Import full OSM files in parallel using `num` COPY streams
+            per object type. 0 disables parallel import. Note that each
+            stream needs its own connection from the connection pool.
+            The pool is resized accordingly.
+        """
+        self.import_streams = num
+        self._resize_pool()
+
+    def set_update_streams(self, num):
+        """ Apply change files in parallel using `num` connections per
+            object type. 0 disables parallel updates. Has no effect when
+            batch updates are enabled. The connection pool is resized
+            accordingly.
+        """
+        self.update_streams = num
+        self._resize_pool()
+
+    def set_bulk_load(self, enable=True, settings=None):
+        """ Use the bulk-load profile for importing full OSM files: data
+            is loaded into UNLOGGED tables. create_indices() then builds
+            the indices in parallel with the session `settings` (defaults
+            to BULK_LOAD_SETTINGS), switches the tables back to LOGGED and
+            analyses them. create_indices() must always be run after an
+            import with this profile.
+        """
+        if enable:
+            self.bulk_load = dict(BULK_LOAD_SETTINGS if settings is None else settings)
+        else:
+            self.bulk_load = None
+
+    def _resize_pool(self):
+        """ Recreate the engine with a connection pool that is large
+            enough for all parallel streams: one connection per stream
+            and object type plus one for the main thread.
+        """
+        pool_size = max(5, 3 * max(self.import_streams, self.update_streams) + 1)
+        if pool_size != self.engine.pool.size():
+            self.engine.dispose()
+            self.engine = sa.create_engine(self.dburl, echo=self.verbose,
+                                           pool_size=pool_size)
+
     def create_database(self):
         database_create(self.dbname)
 
@@ -210,20 +696,26 @@ class BaseImportManager:
 
 
     def process_file(self, filename, is_change_file=None):
-        """ Apply data from a file. This may be a change file.
+        """ Apply data from a file. This may be a change file. Change
+            files are simplified on the fly, i.e. only the newest version
+            of each object is applied.
         """
         reader = osmium.io.Reader(filename)
         if is_change_file is None:
             is_change_file = reader.header().has_multiple_object_versions
 
         if is_change_file:
+            reader.close()
+            diffs = osmium.MergeInputReader()
+            diffs.add_file(filename)
             self._prepare_changeset()
-            handler = UpdateHandler(self.engine, self.tables, self.nodestore is None)
+            with closing(self._make_update_handler()) as h:
+                self._apply_changes(diffs, h)
         else:
-            handler = ImportHandler(self.engine)
-
-        with closing(handler) as h:
-            osmium.apply(reader, *self._make_extra_handlers(is_change_file), h)
+            if self.bulk_load is not None:
+                self._set_tables_logged(False)
+            with closing(ImportHandler(self.engine, self.import_streams)) as h:
+                osmium.apply(reader, *self._make_extra_handlers(False), h)
 
         if self.replication is not None:
             ts = osmium.replication.newest_change_from_file(filename)
@@ -237,6 +729,56 @@ class BaseImportManager:
     def process_replication(self, max_size=1024):
         """ Apply updates from the configured replication source.
         """
+        diffs = self.replication.collect_diffs(start_id=self._get_sequence(),
+                                               max_size=max_size)
+        if diffs is None:
+            return
+
+        self._prepare_changeset()
+        self._apply_diffs(diffs)
+
+
+    def catch_up(self, max_size=1024, max_batches=None):
+        """ Apply all available updates from the configured replication
+            source in batches of `max_size` kB. While one batch is applied,
+            the next one is downloaded and decompressed in a background
+            thread. The replication status is saved after each batch.
+            `max_batches` optionally limits the number of batches.
+
+            The changesets accumulate the changes of all batches. They
+            are also kept when the derived tables have not yet processed
+            the changes of an earlier, interrupted run, i.e. when any part
+            in the status table is behind the base tables.
+
+            Returns the number of batches applied.
+        """
+        start = self._get_sequence()
+        self._prepare_changeset(keep_unprocessed=True)
+
+        done = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(self.replication.collect_diffs,
+                                      start_id=start, max_size=max_size)
+            while pending is not None:
+                diffs = pending.result()
+                if diffs is None:
+                    break
+
+                done += 1
+                if max_batches is None or done < max_batches:
+                    pending = executor.submit(self.replication.collect_diffs,
+                                              start_id=diffs.id + 1, max_size=max_size)
+                else:
+                    pending = None
+
+                log.info("Applying diffs up to %d (%d available).",
+                         diffs.id, diffs.newest)
+                self._apply_diffs(diffs)
+
+        return done
+
+
+    def _get_sequence(self):
         if self.replication is None:
             raise RuntimeError("Need replication source to apply updates")
 
@@ -245,14 +787,12 @@ class BaseImportManager:
             if seq is None:
                 raise RuntimeError("Replication sequence missing.")
 
-        diffs = self.replication.collect_diffs(start_id=seq, max_size=max_size)
-        if diffs is None:
-            return
+        return seq
 
-        self._prepare_changeset()
 
-        with closing(UpdateHandler(self.engine, self.tables, self.nodestore is None)) as h:
-            diffs.reader.apply(*self._make_extra_handlers(True), h)
+    def _apply_diffs(self, diffs):
+        with closing(self._make_update_handler()) as h:
+            self._apply_changes(diffs.reader, h)
 
         diffinfo = self.replication.get_state_info(diffs.id)
         if diffinfo is not None:
@@ -260,6 +800,26 @@ class BaseImportManager:
                 self.status.set_status(conn, 'base', diffinfo.timestamp,
                                        sequence=diffinfo.sequence)
 
+    def _apply_changes(self, reader, handler):
+        """ Apply the changes in the MergeInputReader `reader` with the given
+            update handler. Only the last version of each object is kept.
+        """
+        # Update handlers need to see the node store before the change.
+        reader.apply(handler, *self._make_extra_handlers(True), simplify=True)
+
+    def _make_update_handler(self):
+        if self.batch_updates:
+            return BatchUpdateHandler(self.engine, self.tables,
+                                      self.nodestore is None, self.nodestore)
+
+        if self.update_streams:
+            return ParallelUpdateHandler(self.engine, self.tables,
+                                         self.nodestore is None, self.nodestore,
+                                         num_streams=self.update_streams)
+
+        return UpdateHandler(self.engine, self.tables,
+                             self.nodestore is None, self.nodestore)
+
     def _make_extra_handlers(self, is_change):
         handlers = []
         if self.nodestore is not None:
@@ -270,11 +830,27 @@ class BaseImportManager:
         return handlers
 
 
-    def _prepare_changeset(self):
+    def _prepare_changeset(self, keep_unprocessed=False):
+        """ Get the changesets ready for new changes. The old changes are
+            removed unless `keep_unprocessed` is set and some derived
+            tables have not caught up with the base tables yet. The new
+            changes are then appended.
+        """
         with self.engine.begin() as conn:
+            truncate = True
+            if keep_unprocessed and self.status is not None:
+                st = self.status.table
+                lagging = conn.scalars(sa.select(st.c.part)
+                                         .where(st.c.sequence < self.status.get_sequence(conn))
+                                         .order_by(st.c.part)).all()
+                if lagging:
+                    log.warning("Tables behind the base tables: %s. Keeping old changes.",
+                                ', '.join(lagging))
+                    truncate = False
             for n in ('node', 'way', 'relation'):
                 conn.execute(sa.text(f"DROP INDEX IF EXISTS pk_{n}_change"))
-                conn.execute(sa.text(f"TRUNCATE {n}_changeset"))
+                if truncate:
+                    conn.execute(sa.text(f"TRUNCATE {n}_changeset"))
 
 
     def create_indices(self, for_change=False):
@@ -283,11 +859,48 @@ class BaseImportManager:
                 for n in ('node', 'way', 'relation'):
                     i = sa.Index('pk_%s_change' % n, self.tables[n].change.c.id)
                     i.create(conn)
-            else:
+            elif self.bulk_load is None:
                 for n in ('node', 'way', 'relation'):
                     i = sa.Index('pk_%ss' % n, self.tables[n].data.c.id, unique=True)
                     i.create(conn)
 
+        if not for_change and self.bulk_load is not None:
+            self._finish_bulk_load()
+
+
+    def _set_tables_logged(self, logged):
+        with self.engine.begin() as conn:
+            for n in ('node', 'way', 'relation'):
+                conn.execute(sa.text('ALTER TABLE "{}" SET {}'.format(
+                                 self.tables[n].data.name,
+                                 'LOGGED' if logged else 'UNLOGGED')))
+
+
+    def _create_index_tuned(self, index):
+        with self.engine.begin() as conn:
+            for k, v in self.bulk_load.items():
+                conn.execute(sa.select(sa.func.set_config(k, str(v), True)))
+            index.create(conn)
+
+
+    def _finish_bulk_load(self):
+        """ Build the primary indices of the OSM tables in parallel, make
+            the tables crash-safe again and update their statistics.
+        """
+        tables = [self.tables[n].data for n in ('node', 'way', 'relation')]
+        indices = [sa.Index('pk_%ss' % n, self.tables[n].data.c.id, unique=True)
+                   for n in ('node', 'way', 'relation')]
+
+        with ThreadPoolExecutor(max_workers=len(indices)) as executor:
+            for future in [executor.submit(self._create_index_tuned, i) for i in indices]:
+                future.result()
+
+        self._set_tables_logged(True)
+
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            for t in tables:
+                conn.execute(Analyse(t))
+
 
     def grant_read_access(self, user):
         with self.engine.begin() as conn:
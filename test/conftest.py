@@ -28,12 +28,26 @@ class DBOptions:
     status = False
     no_engine = True
 
+# Settings for the import manager to run the importer tests with
+# (see the db_all_modes fixture). Maps the setter function to its parameter.
+IMPORT_MODES = {
+    'default': {},
+    'parallel': {'set_import_streams': 2, 'set_update_streams': 2},
+    'batch': {'set_batch_updates': True},
+    'bulk': {'set_bulk_load': True}
+}
+
 class TestableDB:
 
-    def __init__(self, tempdir):
+    def __init__(self, tempdir, mode=None):
         self.tempdir = tempdir
+        self.mode = mode or {}
         self.db = MapDB(DBOptions())
 
+    def _setup_manager(self, mgr):
+        for func, param in self.mode.items():
+            getattr(mgr, func)(param)
+
     def import_data(self, data, grid=None):
         database_drop(DBOptions.database, True)
         osm_data = ""
@@ -71,6 +85,7 @@ class TestableDB:
             fd.write(b'\n')
             fd.flush()
             with BaseImportManager(DBOptions.database) as mgr:
+                self._setup_manager(mgr)
                 mgr.create_database()
                 mgr.process_file(fd.name, False)
                 mgr.create_indices()
@@ -89,6 +104,7 @@ class TestableDB:
             fd.write(b'\n')
             fd.flush()
             with BaseImportManager(DBOptions.database) as mgr:
+                self._setup_manager(mgr)
                 mgr.process_file(fd.name, True)
 
         self.db.update()
@@ -96,6 +112,9 @@ class TestableDB:
     def add_table(self, table):
         return TestableTable(self.db, self.db.add_table(table.data.name, table))
 
+    def osm_table(self, name):
+        return TestableTable(self.db, self.db.osmdata[name])
+
 
 class TestableTable:
 
@@ -134,11 +153,23 @@ class TestableTable:
         self._contains(self.table.change, as_array)
 
 
-@pytest.fixture
-def db(tmp_path):
-    db = TestableDB(tmp_path)
+def _make_db(tmp_path, mode=None):
+    db = TestableDB(tmp_path, mode)
 
     yield db
 
     if hasattr(db.db, 'engine'):
         db.db.engine.dispose()
+
+
+@pytest.fixture
+def db(tmp_path):
+    yield from _make_db(tmp_path)
+
+
+@pytest.fixture(params=IMPORT_MODES.keys())
+def db_all_modes(request, tmp_path):
+    """ Database that is imported and updated with each of the
+        IMPORT_MODES of the import manager.
+    """
+    yield from _make_db(tmp_path, IMPORT_MODES[request.param])
@@ -4,8 +4,10 @@
 # Copyright (C) 2024 Sarah Hoffmann
 from itertools import count
 
+import numpy as np
 import pytest
 
+from geoalchemy2.shape import to_shape
 from shapely.geometry import LineString, MultiLineString
 
 import osgende.common.build_geometry as builder
@@ -98,3 +100,27 @@ def test_two_separate_relations(build):
 
 def test_circular_with_end(build):
     check_geom('1,2,3,4,5,2,1', build('W[100]1,2', 'W2,3,4', 'W2,5,4', 'W[100]1,2'))
+
+
+def test_project_to_mercator():
+    coords = builder.project_to_mercator([(0, 0), (180, 0), (10, 50), (0, 89)])
+
+    assert coords[0].tolist() == pytest.approx([0, 0], abs=1e-6)
+    assert coords[1, 0] == pytest.approx(20037508.3428)
+    assert coords[2].tolist() == pytest.approx([1113194.9079, 6446275.8410])
+    assert coords[3, 1] == pytest.approx(20037508.3428)
+
+
+def test_build_linestrings():
+    geoms = builder.build_linestrings([np.array([(1.0, 2.0), (3.0, 4.0)]),
+                                       np.zeros((1, 2)),
+                                       np.array([(0, 0), (1, 1), (2, 0.5)])], 4326)
+
+    assert geoms[1] is None
+    assert to_shape(geoms[0]) == LineString([(1, 2), (3, 4)])
+    assert to_shape(geoms[2]) == LineString([(0, 0), (1, 1), (2, 0.5)])
+    assert all(g.srid == 4326 for g in (geoms[0], geoms[2]))
+
+
+def test_build_linestrings_empty():
+    assert builder.build_linestrings([np.zeros((0, 2))], 3857) == [None]
@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of Osgende.
+# Copyright (C) 2024 Sarah Hoffmann
+"""
+Tests for the bulk writer and its helper functions.
+"""
+from binascii import hexlify
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import shapely
+import sqlalchemy as sa
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point
+
+from osgende.common.bulk import to_ewkb, linestring_ewkb, BulkInserter
+
+def test_to_ewkb_from_wkb_element():
+    geom = from_shape(Point(10.0, 3.0), srid=4326)
+
+    assert '0101000020e610000000000000000024400000000000000840'\
+             == hexlify(to_ewkb(geom)).decode()
+
+
+def test_to_ewkb_from_extended_wkb_element():
+    geom = from_shape(Point(-68.0, 12.0), srid=3857, extended=True)
+
+    assert '0101000020110f000000000000000051c00000000000002840'\
+             == hexlify(to_ewkb(geom)).decode()
+
+
+def test_to_ewkb_passthrough():
+    assert b'\x01\x02' == to_ewkb(b'\x01\x02')
+    assert to_ewkb(None) is None
+
+
+def test_linestring_ewkb():
+    coords = np.array([(1.0, 2.5), (-3.0, 4.0), (0.0, 0.0)])
+
+    wkb = linestring_ewkb(coords, 3857)
+
+    assert wkb.srid == 3857
+    assert wkb.extended
+    geom = shapely.from_wkb(bytes(wkb.data))
+    assert geom.geom_type == 'LineString'
+    assert list(geom.coords) == [(1.0, 2.5), (-3.0, 4.0), (0.0, 0.0)]
+    assert shapely.get_srid(geom) == 3857
+
+
+class FakeConnection:
+    """ Non-psycopg connection that records the inserted rows. """
+
+    def __init__(self):
+        self.connection = SimpleNamespace(dbapi_connection=None)
+        self.rows = []
+
+    def execute(self, sql):
+        self.rows.extend(p for p in sql.compile().params.values())
+
+
+@pytest.fixture
+def inserter():
+    table = sa.Table('test', sa.MetaData(),
+                     sa.Column('id', sa.BigInteger),
+                     sa.Column('name', sa.String),
+                     sa.Column('ref', sa.String))
+    return BulkInserter(FakeConnection(), table)
+
+
+def test_bulk_inserter_missing_columns(inserter):
+    inserter.add({'id': 1, 'name': 'A'})
+    inserter.add({'id': 2, 'ref': 'x'})
+    inserter.flush()
+
+    assert inserter.conn.rows == [1, 'A', None, 2, None, 'x']
+
+
+def test_bulk_inserter_unknown_column(inserter):
+    inserter.add({'id': 1, 'foo': 'A'})
+
+    with pytest.raises(ValueError, match='foo'):
+        inserter.flush()
@@ -211,3 +211,78 @@ def test_update_delete_from_grouped_middle_split(db, table):
     db.update_data("w9 v2 dD")
     table.has_changes('M6', 'A10')
     table.has_data(*H({6 : [6, 7], 10 : [10, 11]}))
+
+
+class _ListWriter:
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+
+
+def test_write_groups_in_memory():
+    writer = _ListWriter()
+    GroupedWayTable._write_groups([(5, [1, 2, 3]), (6, [3, 4, 5]),
+                                   (7, [5, 6, 1]), (8, [10, 11]),
+                                   (9, [12]), (10, [11, None])], writer)
+
+    assert sorted((r['id'], r['child']) for r in writer.rows) \
+             == [(5, 5), (5, 6), (5, 7), (8, 8), (8, 10)]
+
+
+def test_assign_group_ids_keeps_old_ids():
+    assert GroupedWayTable._assign_group_ids(
+               [[7, 9], [10, 11, 12]], {6: {6, 7, 9, 10, 11}}, {8, 12}, set())\
+             == {6: [7, 9], 12: [10, 11, 12]}
+
+
+def test_assign_group_ids_skips_used():
+    assert GroupedWayTable._assign_group_ids(
+               [[5, 6, 7]], {}, {5}, {5})\
+             == {6: [5, 6, 7]}
+
+
+@pytest.fixture
+def indexed_table(db):
+    return db.add_table(GroupedWayTable(db.db.metadata, 'test',
+                                        db.db.osmdata.way, ('tags', ),
+                                        node_index=True))
+
+
+def test_indexed_update_connecting_grouped(db, indexed_table):
+    db.import_data("""
+     w6 Ttype=foo Nn4,n5,n6
+     w7 Ttype=foo Nn3,n6
+     w10 Ttype=foo Nn100,n102
+     w11 Ttype=foo Nn101,n102
+     w12 Ttype=bar Nn100,n103
+    """)
+    db.update_data("w5 Ttype=foo Nn5,n100")
+    indexed_table.has_changes('M6', 'D10')
+    indexed_table.has_data(*H({6 : [6, 7, 5, 10, 11]}))
+
+
+def test_indexed_update_split(db, indexed_table):
+    db.import_data("""
+     w6 Ttype=foo Nn1,n2
+     w7 Ttype=foo Nn2,n3
+     w9 Ttype=foo Nn3,n6
+     w10 Ttype=foo Nn5,n6
+     w11 Ttype=foo Nn5,n4
+    """)
+    db.update_data("w9 v2 dD")
+    indexed_table.has_changes('M6', 'A10')
+    indexed_table.has_data(*H({6 : [6, 7], 10 : [10, 11]}))
+
+
+def test_indexed_update_modify_member(db, indexed_table):
+    db.import_data("""
+     w6 Ttype=foo Nn1,n2
+     w7 Ttype=foo Nn2,n3
+     w9 Ttype=foo Nn10,n11
+    """)
+    db.update_data("w7 v2 Ttype=foo Nn2,n4,n3")
+    indexed_table.has_changes('M6')
+    indexed_table.has_data(*H({6 : [6, 7]}))
@@ -51,3 +51,45 @@ def test_self_contained(db, rel_table):
         """)
     rel_table.has_data({ 'parent' : 1, 'child' : 2, 'depth' : 2 })
 
+
+
+def test_max_depth(db):
+    table = db.add_table(RelationHierarchy(db.db.metadata, "test",
+                                           db.db.osmdata.relation, max_depth=3))
+    db.import_data("""
+        r1 Mr2@
+        r2 Mr3@
+        r3 Mr4@
+        """)
+    table.has_data({ 'parent' : 1, 'child' : 2, 'depth' : 2 },
+                   { 'parent' : 1, 'child' : 3, 'depth' : 3 },
+                   { 'parent' : 2, 'child' : 3, 'depth' : 2 },
+                   { 'parent' : 2, 'child' : 4, 'depth' : 3 },
+                   { 'parent' : 3, 'child' : 4, 'depth' : 2 })
+
+
+def test_update_add_subrelation(db, rel_table):
+    db.import_data("""
+        r1 Mr2@
+        r2 Mw3@
+        r5 Mr6@
+        """)
+    db.update_data("""
+        r2 v2 Mr3@
+        """)
+    rel_table.has_data({ 'parent' : 1, 'child' : 2, 'depth' : 2 },
+                       { 'parent' : 1, 'child' : 3, 'depth' : 3 },
+                       { 'parent' : 2, 'child' : 3, 'depth' : 2 },
+                       { 'parent' : 5, 'child' : 6, 'depth' : 2 })
+
+
+def test_update_remove_subrelation(db, rel_table):
+    db.import_data("""
+        r1 Mr2@
+        r2 Mr3@
+        r3 Mw3@
+        """)
+    db.update_data("""
+        r2 v2 Mw3@
+        """)
+    rel_table.has_data({ 'parent' : 1, 'child' : 2, 'depth' : 2 })
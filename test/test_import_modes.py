@@ -0,0 +1,128 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of Osgende
+# Copyright (C) 2024 Sarah Hoffmann
+"""
+Tests for importing and updating the OSM base tables with the different
+modes of the import manager.
+"""
+import pytest
+import sqlalchemy as sa
+
+
+@pytest.fixture
+def osm(db_all_modes):
+    db_all_modes.import_data("""\
+        n1 Tamenity=bench x1.0 y2.0
+        n2 x1.5 y2.5
+        n3 x1.7 y2.7
+        w10 Thighway=path Nn1,n2
+        w11 Thighway=track Nn2,n3
+        r20 Ttype=route Mw10@,n1@stop
+        r21 Ttype=route Mr20@
+        """)
+
+    return db_all_modes
+
+
+def node_locations(db, table):
+    with db.db.engine.begin() as conn:
+        return {r[0]: (r[1], r[2]) for r in conn.execute(sa.text(
+                    f"SELECT id, ST_X(geom), ST_Y(geom) FROM {table}"))}
+
+
+def test_import(osm):
+    osm.osm_table('node').has_data(
+        {'id': 1, 'tags': {'amenity': 'bench'}},
+        {'id': 2, 'tags': {}},
+        {'id': 3, 'tags': {}})
+    osm.osm_table('way').has_data(
+        {'id': 10, 'tags': {'highway': 'path'}, 'nodes': [1, 2]},
+        {'id': 11, 'tags': {'highway': 'track'}, 'nodes': [2, 3]})
+    osm.osm_table('relation').has_data(
+        {'id': 20, 'tags': {'type': 'route'},
+         'members': [{'type': 'W', 'id': 10, 'role': ''},
+                     {'type': 'N', 'id': 1, 'role': 'stop'}]},
+        {'id': 21, 'tags': {'type': 'route'},
+         'members': [{'type': 'R', 'id': 20, 'role': ''}]})
+
+    assert node_locations(osm, 'nodes') == {1: (1.0, 2.0), 2: (1.5, 2.5), 3: (1.7, 2.7)}
+
+
+def test_import_tables_finished(osm):
+    with osm.db.engine.begin() as conn:
+        persistence = dict(conn.execute(sa.text(
+            """SELECT relname, relpersistence FROM pg_class
+                WHERE relname in ('nodes', 'ways', 'relations')""")).all())
+        indices = set(conn.scalars(sa.text(
+            """SELECT indexname FROM pg_indexes
+                WHERE tablename in ('nodes', 'ways', 'relations')""")))
+
+    assert persistence == {'nodes': 'p', 'ways': 'p', 'relations': 'p'}
+    assert {'pk_nodes', 'pk_ways', 'pk_relations'} <= indices
+
+
+def test_update_nodes(osm):
+    osm.update_data("""\
+        n1 v2 Tamenity=bench,name=A x1.0 y2.0
+        n2 v2 x1.6 y2.5
+        n3 v2 dD
+        n4 v1 Tshop=bakery x3.0 y4.0
+        """)
+
+    nodes = osm.osm_table('node')
+    nodes.has_data(
+        {'id': 1, 'tags': {'amenity': 'bench', 'name': 'A'}},
+        {'id': 2, 'tags': {}},
+        {'id': 4, 'tags': {'shop': 'bakery'}})
+    nodes.has_changes('M1', 'M2', 'D3', 'A4')
+
+    assert node_locations(osm, 'nodes') == {1: (1.0, 2.0), 2: (1.6, 2.5), 4: (3.0, 4.0)}
+
+    with osm.db.engine.begin() as conn:
+        old = {r[0]: r[1] for r in conn.execute(sa.text(
+                  """SELECT id, ST_AsText(old_geom) FROM node_changeset"""))}
+    assert old == {1: 'POINT(1 2)', 2: 'POINT(1.5 2.5)',
+                   3: 'POINT(1.7 2.7)', 4: None}
+
+
+def test_update_ways(osm):
+    osm.update_data("""\
+        w10 v2 Thighway=path Nn1,n2,n3
+        w11 v2 dD
+        w12 v1 Thighway=steps Nn3,n1
+        """)
+
+    ways = osm.osm_table('way')
+    ways.has_data(
+        {'id': 10, 'tags': {'highway': 'path'}, 'nodes': [1, 2, 3]},
+        {'id': 12, 'tags': {'highway': 'steps'}, 'nodes': [3, 1]})
+    ways.has_changes('M10', 'D11', 'A12')
+
+
+def test_update_relations(osm):
+    osm.update_data("""\
+        r20 v2 Ttype=route Mw10@,w11@
+        r21 v2 dD
+        r22 v1 Ttype=network Mr20@
+        """)
+
+    rels = osm.osm_table('relation')
+    rels.has_data(
+        {'id': 20, 'tags': {'type': 'route'},
+         'members': [{'type': 'W', 'id': 10, 'role': ''},
+                     {'type': 'W', 'id': 11, 'role': ''}]},
+        {'id': 22, 'tags': {'type': 'network'},
+         'members': [{'type': 'R', 'id': 20, 'role': ''}]})
+    rels.has_changes('M20', 'D21', 'A22')
+
+
+def test_update_latest_version_wins(osm):
+    osm.update_data("""\
+        w10 v2 Thighway=path Nn1,n3
+        w10 v3 Thighway=footway Nn1,n2
+        """)
+
+    osm.osm_table('way').has_data(
+        {'id': 10, 'tags': {'highway': 'footway'}, 'nodes': [1, 2]},
+        {'id': 11, 'tags': {'highway': 'track'}, 'nodes': [2, 3]})
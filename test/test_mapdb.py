@@ -2,9 +2,13 @@
 #
 # This file is part of Osgende
 # Copyright (C) 2024 Sarah Hoffmann
+import threading
+import time
+
 import pytest
+import sqlalchemy as sa
 
-from osgende.mapdb import _Tables
+from osgende.mapdb import MapDB, _Tables, _run_scheduled
 
 @pytest.fixture
 def tables():
@@ -39,3 +43,97 @@ def test_has_attribute(tables):
 
 def test_len(tables):
     assert 2 == len(tables)
+
+
+class _Options:
+    no_engine = True
+    status = False
+
+
+class _DummyTable:
+
+    def __init__(self, src=None):
+        if src is not None:
+            self.src = src
+
+
+def test_add_table_dependencies():
+    db = MapDB(_Options())
+    t1 = db.add_table('t1', _DummyTable(db.osmdata.way))
+    t2 = db.add_table('t2', _DummyTable(t1))
+    t3 = db.add_table('t3', _DummyTable(), depends_on=('t1', t2))
+
+    assert db.dependencies[t1] == set()
+    assert db.dependencies[t2] == {t1}
+    assert db.dependencies[t3] == {t1, t2}
+
+
+@pytest.mark.parametrize('parallel', (1, 2, 4))
+def test_run_scheduled_order(parallel):
+    lock = threading.Lock()
+    done = []
+
+    def _run(job):
+        time.sleep(0.01 * (5 - job))
+        with lock:
+            done.append(job)
+
+    _run_scheduled([1, 2, 3, 4], {3: {1}, 4: {2, 3}}, _run, parallel)
+
+    assert sorted(done) == [1, 2, 3, 4]
+    assert done.index(3) > done.index(1)
+    assert done.index(4) > done.index(3)
+    assert done.index(4) > done.index(2)
+
+
+def test_run_scheduled_parallel():
+    barrier = threading.Barrier(2, timeout=5)
+
+    # Fails with a BrokenBarrierError when the jobs are not run concurrently.
+    _run_scheduled(['a', 'b'], {}, lambda _: barrier.wait(), 2)
+
+
+def test_run_scheduled_error():
+    done = []
+
+    def _run(job):
+        if job == 1:
+            raise ValueError()
+        done.append(job)
+
+    with pytest.raises(ValueError):
+        _run_scheduled([1, 2], {2: {1}}, _run, 2)
+
+    assert done == []
+
+
+def test_run_scheduled_circular():
+    with pytest.raises(RuntimeError):
+        _run_scheduled([1, 2], {1: {2}, 2: {1}}, lambda _: None, 2)
+
+
+def test_parallel_tables_with_processes():
+    options = _Options()
+    options.parallel_tables = 2
+    db = MapDB(options)
+    table = db.add_table('t1', _DummyTable())
+    table.numthreads = 2
+    table.use_processes = True
+
+    with pytest.raises(RuntimeError):
+        db._process_tables(lambda _: None)
+
+
+def test_parallel_tables_pool_size():
+    options = _Options()
+    options.parallel_tables = 3
+    db = MapDB(options)
+    db.engine = sa.create_engine('postgresql+psycopg:///osgende_test')
+    table = db.add_table('t1', _DummyTable())
+    table.numthreads = 4
+    db.add_table('t2', _DummyTable())
+
+    db._process_tables(lambda _: None)
+
+    assert db.engine.pool.size() == 18
+    db.engine.dispose()
@@ -5,7 +5,7 @@
 
 import pytest
 
-from osgende.common.nodestore import NodeStore, NodeStorePoint
+from osgende.common.nodestore import NodeStore, NodeStorePoint, ReadOnlyNodeStore
 
 def test_point_wkb():
     assert '0101000020e610000000000000000024400000000000000840'\
@@ -58,3 +58,47 @@ def test_create_reload(tmpdir):
         assert store[i] == NodeStorePoint(i/10000000.0, 1)
 
     store.close()
+
+
+def test_get_many(tmpdir):
+    store = NodeStore(str(tmpdir / 'test.store'))
+
+    for i in range(100, 110):
+        store[i] = NodeStorePoint(i/100.0, 1)
+
+    coords, valid = store.get_many([105, 3, 100, None, 16000, 109])
+
+    assert valid.tolist() == [True, False, True, False, False, True]
+    assert coords[valid].tolist() == [[1.05, 1.0], [1.0, 1.0], [1.09, 1.0]]
+
+    store.close()
+
+
+def test_readonly_store(tmpdir):
+    store = NodeStore(str(tmpdir / 'test.store'))
+
+    for i in range(25500, 26000):
+        store[i] = NodeStorePoint(-179.9999999 + i/1000.0, 89.1234567 - i/1000.0)
+
+    store.close()
+    del store
+
+    rostore = ReadOnlyNodeStore(str(tmpdir / 'test.store'))
+    store = NodeStore(str(tmpdir / 'test.store'))
+
+    for i in range(25500, 26000):
+        assert rostore[i] == store[i]
+
+    for i in (0, 1000, 26000, 100000000):
+        with pytest.raises(KeyError):
+            rostore[i]
+
+    ids = [25600, 1000, None, 25999, 100000000]
+    coords, valid = rostore.get_many(ids)
+    exp_coords, exp_valid = store.get_many(ids)
+
+    assert valid.tolist() == exp_valid.tolist()
+    assert coords[valid].tolist() == exp_coords[exp_valid].tolist()
+
+    rostore.close()
+    store.close()
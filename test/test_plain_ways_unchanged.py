@@ -6,8 +6,11 @@
 Tests for PlainWayTable without modified tags.
 """
 import pytest
+from geoalchemy2.shape import from_shape
+from shapely.geometry import LineString
 
 from osgende.lines import PlainWayTable
+from osgende.lines.plain import _linestring_coords
 from db_compare import Line
 
 
@@ -16,8 +19,9 @@ EXPECT_W101 = { 'id' : 101, 'tags' : { 'name' : 'first' },
 EXPECT_W103 = { 'id' : 103, 'tags' : { 'name' : 'second' },
                 'nodes' : [34, 1, 36], 'geom' : Line(34, 1, 36) }
 
-@pytest.fixture
-def test_table(db):
+@pytest.fixture(params=(1000, 1))
+def test_table(db, request):
+    db.db.set_metadata('construct_chunk_size', request.param)
     table = db.add_table(PlainWayTable(db.db.metadata, "test",
                                        db.db.osmdata.way, db.db.osmdata))
 
@@ -53,6 +57,16 @@ def test_update_change_tags(db, test_table):
     new_w101.update({'tags' : {"name" : "new"}})
     test_table.has_data(new_w101, EXPECT_W103)
 
+def test_update_change_tags_multiple_versions(db, test_table):
+    db.update_data("""\
+        w101 v2 Tname=new Nn1,n2
+        w101 v3 Tname=newer Nn1,n2
+        """)
+    test_table.has_changes('M101')
+    new_w101 = dict(EXPECT_W101)
+    new_w101.update({'tags' : {"name" : "newer"}})
+    test_table.has_data(new_w101, EXPECT_W103)
+
 def test_update_add_node(db, test_table):
     db.update_data("""w101 v2 Tname=first Nn1,n2,n3""")
     test_table.has_changes('M101')
@@ -71,3 +85,29 @@ def test_move_node(db, test_table):
     test_table.has_data(EXPECT_W103,
         { 'id' : 101, 'tags' : { 'name' : 'first' },
                 'nodes' : [1, 2], 'geom' : Line(1, (0.9, 2.1)) })
+
+def test_move_node_tags_only(db, test_table):
+    db.update_data("""n2 v2 Tfoo=bar x1.0 y2.2""")
+    test_table.has_changes()
+    test_table.has_data(EXPECT_W101, EXPECT_W103)
+
+def test_move_node_and_change_tags(db, test_table):
+    db.update_data("""\
+        n2 v2 Tfoo=bar x1.0 y2.2
+        w101 v2 Tname=new Nn1,n2
+        """)
+    test_table.has_changes('M101')
+    new_w101 = dict(EXPECT_W101)
+    new_w101.update({'tags' : {"name" : "new"}})
+    test_table.has_data(new_w101, EXPECT_W103)
+
+
+@pytest.mark.parametrize('srid', [None, 4326])
+def test_linestring_coords(srid):
+    geom = from_shape(LineString([(1, 2), (3.5, -4.25)]),
+                      **({} if srid is None else {'srid': srid}))
+
+    coords = _linestring_coords(geom.data)
+
+    assert coords.tolist() == [[1, 2], [3.5, -4.25]]
+    assert _linestring_coords(bytes(geom.data).hex()).tolist() == coords.tolist()
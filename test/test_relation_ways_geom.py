@@ -6,6 +6,7 @@
 Tests for RelationWaysTable with geometries enabled.
 """
 import pytest
+import shapely
 
 from osgende.lines import RelationWayTable
 
@@ -224,3 +225,24 @@ class TestSimpleRelationWaysUpdateSimpleRelationChanges:
     def test_update_add_relation_member(self, db, test_table):
         db.update_data("r2 v2 Mr3@,w1@,w2@")
         self.is_unchanged()
+
+
+class LegacyGeometryTable(RelationWayTable):
+
+    def make_geometry(self, points):
+        return shapely.LineString([(p.x, p.y) for p in reversed(points)])
+
+
+def test_create_legacy_make_geometry(db):
+    with pytest.warns(DeprecationWarning):
+        table = db.add_table(LegacyGeometryTable(db.db.metadata, "test",
+                                                 db.db.osmdata.way,
+                                                 db.db.osmdata.relation,
+                                                 db.db.osmdata))
+    db.import_data("""\
+        w1 Nn1,n3
+        r1 Mw1@
+        """, NODES)
+    table.has_data(
+        { 'id' : 1, 'nodes' : [1, 3], 'rels' : [1], 'geom' : Line(3, 1) }
+        )
@@ -0,0 +1,139 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of Osgende
+# Copyright (C) 2024 Sarah Hoffmann
+"""
+Tests for reading and applying replication diffs from a local directory.
+"""
+import gzip
+from datetime import datetime, timezone
+
+import pytest
+import sqlalchemy as sa
+
+from osgende.tools.importing import LocalReplicationServer, BaseImportManager
+from osgende.common.sqlalchemy.database import database_drop
+
+OSC = """\
+<?xml version='1.0' encoding='UTF-8'?>
+<osmChange version="0.6" generator="test">
+<modify>
+<node id="{0}" version="2" timestamp="2024-01-0{0}T00:00:00Z" lat="1.0" lon="2.0">
+{1}
+</node>
+</modify>
+</osmChange>
+"""
+
+# Pads each diff beyond 1kB, so that catch_up(max_size=1) applies
+# one diff per batch.
+PADDING = '\n'.join(f'<tag k="note{i}" v="{"x" * 250}"/>' for i in range(5))
+
+def write_state(path, seq):
+    path.write_text(f"sequenceNumber={seq}\ntimestamp=2024-01-0{seq}T00\\:00\\:00Z\n")
+
+@pytest.fixture
+def repl_dir(tmp_path):
+    diffdir = tmp_path / '000' / '000'
+    diffdir.mkdir(parents=True)
+    for seq in (1, 2, 3):
+        with gzip.open(diffdir / f'00{seq}.osc.gz', 'wt') as fd:
+            fd.write(OSC.format(seq, PADDING))
+        write_state(diffdir / f'00{seq}.state.txt', seq)
+    write_state(tmp_path / 'state.txt', 3)
+
+    return tmp_path
+
+
+class CollectNodes:
+    def __init__(self):
+        self.ids = []
+
+    def node(self, n):
+        self.ids.append(n.id)
+
+
+@pytest.mark.parametrize('as_url', [True, False])
+def test_local_state(repl_dir, as_url):
+    repl = LocalReplicationServer(repl_dir.as_uri() if as_url else str(repl_dir))
+
+    assert repl.get_state_info().sequence == 3
+    assert repl.get_state_info(2).sequence == 2
+
+
+def test_local_collect_diffs(repl_dir):
+    repl = LocalReplicationServer(str(repl_dir))
+
+    diffs = repl.collect_diffs(2)
+
+    assert diffs.id == 3
+    assert diffs.newest == 3
+    handler = CollectNodes()
+    diffs.reader.apply(handler)
+    assert handler.ids == [2, 3]
+
+    assert repl.collect_diffs(4) is None
+
+
+@pytest.fixture
+def repl_db(tmp_path, repl_dir):
+    osm_file = tmp_path / 'base.opl'
+    osm_file.write_text(''.join(f"n{i} v1 Tfoo=bar x1 y1\n" for i in (1, 2, 3)))
+
+    database_drop('osgende_test', True)
+    with BaseImportManager('osgende_test') as mgr:
+        mgr.create_database()
+        mgr.process_file(str(osm_file), False)
+        mgr.create_indices()
+
+        mgr.set_replication_source(str(repl_dir))
+        mgr.status.create(mgr.engine)
+        with mgr.engine.begin() as conn:
+            date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+            mgr.status.set_status(conn, 'base', date, 1)
+            mgr.status.set_status(conn, 'derived', date, 1)
+
+        yield mgr
+
+
+def get_changed_nodes(mgr):
+    with mgr.engine.begin() as conn:
+        return set(conn.scalars(sa.text("SELECT id FROM node_changeset")))
+
+
+def test_catch_up(repl_db):
+    assert repl_db.catch_up(max_size=1) == 3
+
+    with repl_db.engine.begin() as conn:
+        assert repl_db.status.get_sequence(conn) == 3
+        assert conn.scalar(sa.text("""SELECT count(*) FROM nodes
+                                       WHERE ST_X(geom) = 2.0
+                                             and ST_Y(geom) = 1.0""")) == 3
+    assert get_changed_nodes(repl_db) == {1, 2, 3}
+
+
+def test_catch_up_resume_keeps_changes(repl_db):
+    assert repl_db.catch_up(max_size=1, max_batches=2) == 2
+    assert get_changed_nodes(repl_db) == {1, 2}
+
+    repl_db.catch_up(max_size=1)
+
+    assert get_changed_nodes(repl_db) == {1, 2, 3}
+
+
+def test_catch_up_truncates_processed_changes(repl_db):
+    repl_db.catch_up(max_size=1, max_batches=2)
+    with repl_db.engine.begin() as conn:
+        repl_db.status.set_status_from(conn, 'derived', 'base')
+
+    repl_db.catch_up(max_size=1)
+
+    assert get_changed_nodes(repl_db) == {2, 3}
+
+
+def test_process_replication_truncates_changes(repl_db):
+    repl_db.catch_up(max_size=1, max_batches=2)
+
+    repl_db.process_replication(max_size=1)
+
+    assert get_changed_nodes(repl_db) == {2}
@@ -8,6 +8,7 @@ Tests for SegmentsTable
 import pytest
 
 from osgende.lines import PlainWayTable, SegmentsTable
+from osgende.lines.segments import _WayCollector
 
 from db_compare import Line, Any, Set
 from db_compare import make_db_line
@@ -18,8 +19,18 @@ def R(nodes, ways, **kargs):
 
 class TestSimpleSegmentsImport:
 
-    @pytest.fixture(autouse=True)
-    def setup_test(self, db):
+    @pytest.fixture(autouse=True,
+                    params=((10000, None), (1, None), (10000, 'count'), (10000, 'spill')),
+                    ids=('default', 'split', 'count', 'spill'))
+    def setup_test(self, db, request, tmp_path):
+        task_size, count_nodes = request.param
+        # a task size of 1 forces splitting of the ways into parts
+        db.db.set_metadata('segments_task_size', task_size)
+        # count the intersections while streaming instead of in the database
+        if count_nodes is not None:
+            db.db.set_metadata('segments_count_nodes', True)
+        if count_nodes == 'spill':
+            db.db.set_metadata('segments_spill_dir', str(tmp_path))
         # need base table from which to derive the segments
         plain = db.add_table(PlainWayTable(db.db.metadata, "base",
                                            db.db.osmdata.way, db.db.osmdata))
@@ -286,6 +297,27 @@ class TestSimpleSegmentsUpdate:
         self.db.update_data(update_data)
         self.segments.has_data(*args)
 
+    def test_failed_update_keeps_segments(self, monkeypatch):
+        self.db.import_data("""\
+            n1 x23.0 y-3.0
+            n2 x23.001 y-3.43
+            n3 x23.002 y-3.5
+            w1 Tref=1 Nn1,n2
+            w2 Tref=1 Nn2,n3
+            """)
+
+        def _fail(*_):
+            raise RuntimeError("collector failed")
+
+        monkeypatch.setattr(_WayCollector, 'process_cached_ways', _fail)
+        with pytest.raises(RuntimeError):
+            self.db.update_data("n3 x23.003 y-3.5")
+
+        self.segments.has_data(
+            {'tags': {'ref': '1'}, 'nodes': [1, 2, 3], 'ways': [1, 2],
+             'geom': Line((23.0, -3.0), (23.001, -3.43), (23.002, -3.5))}
+        )
+
     def test_move_node(self):
         self.db.import_data("""\
             n1 x23.0 y-3.0
@@ -620,3 +652,38 @@ class TestSimpleSegmentsUpdate:
             # result
             R([1, 2], Set(1), tags={'rel' : '1'}),
         )
+
+
+@pytest.mark.parametrize('spill', (False, True))
+def test_node_weight_counter(tmp_path, spill):
+    from osgende.lines.segments import _NodeWeightCounter
+
+    counter = _NodeWeightCounter(buffer_size=3,
+                                 spill_dir=str(tmp_path) if spill else None)
+    for nodes in ([1, 2, 3], [3, 4], [4, 5, 6], [2, 7], [8], [6, 9], [6, 10]):
+        counter.add(nodes)
+
+    assert counter.intersections().tolist() == [2, 6]
+
+
+def test_sorted_ids():
+    import numpy as np
+    from osgende.lines.segments import _SortedIds
+
+    ids = _SortedIds(np.array([2, 6, 10], dtype=np.int64))
+
+    assert [n for n in range(12) if n in ids] == [2, 6, 10]
+
+
+def test_segment_fuse():
+    from array import array
+    import numpy as np
+    from osgende.lines.segments import _Segment
+
+    s1 = _Segment(1, array('q', [3, 2, 1]), np.array([(3, 0), (2, 0), (1, 0)], dtype=float))
+    s2 = _Segment(2, array('q', [5, 4, 3]), np.array([(5, 0), (4, 0), (3, 0)], dtype=float))
+
+    assert s1.fuse(s2, 3) == 5
+    assert s1.nodes.tolist() == [1, 2, 3, 4, 5]
+    assert s1.geom.tolist() == [[1, 0], [2, 0], [3, 0], [4, 0], [5, 0]]
+    assert sorted(s1.osmids) == [1, 2]
@@ -5,6 +5,8 @@
 """ Test threading helpers.
 """
 import time
+import threading
+import multiprocessing
 from itertools import count
 
 import pytest
@@ -56,3 +58,51 @@ def test_queue_deadlock():
     with pytest.raises(WorkerError):
         for i in range(1000):
             queue.add_task(0.1)
+
+
+def test_process_add_task():
+    done = multiprocessing.get_context('fork').SimpleQueue()
+
+    queue = WorkerQueue(done.put, numthreads=3, use_processes=True)
+
+    for i in range(100):
+        queue.add_task(i)
+
+    queue.finish()
+
+    assert set(range(100)) == set(done.get() for _ in range(100))
+    assert done.empty()
+
+
+def test_process_init_shutdown_func():
+    calls = multiprocessing.get_context('fork').SimpleQueue()
+
+    queue = WorkerQueue(lambda x: x, numthreads=3,
+                        initfunc=lambda: calls.put('init'),
+                        shutdownfunc=lambda: calls.put('shutdown'),
+                        use_processes=True)
+
+    queue.finish()
+
+    assert sorted(calls.get() for _ in range(6)) == ['init'] * 3 + ['shutdown'] * 3
+
+
+def test_process_died():
+    queue = WorkerQueue(lambda x: 1/x, numthreads=1, use_processes=True)
+
+    queue.add_task(0)
+    with pytest.raises(WorkerError):
+        queue.finish()
+
+
+def test_process_refuses_running_threads():
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+
+    try:
+        with pytest.raises(RuntimeError):
+            WorkerQueue(print, numthreads=2, use_processes=True)
+    finally:
+        stop.set()
+        thread.join()
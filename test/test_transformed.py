@@ -29,8 +29,10 @@ class TransformedTestTable(TransformedTable):
                  'b' : int(t.get('bar', 0)) }
 
 
-@pytest.fixture
-def test_table(db):
+@pytest.fixture(params=(10000, 1))
+def test_table(db, request):
+    # a chunk size of 1 streams the changes in many chunks
+    db.db.set_metadata('update_chunk_size', request.param)
     table = db.add_table(TransformedTestTable(db.db))
 
     db.import_data("""
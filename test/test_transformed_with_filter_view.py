@@ -29,8 +29,14 @@ class TransformedTestTable(TransformedTable):
                  'b' : int(t.get('bar', 0)) }
 
 
+@pytest.fixture(params=(10000, 1))
+def update_chunk_size(request, db):
+    # a chunk size of 1 streams the changes in many chunks
+    db.db.set_metadata('update_chunk_size', request.param)
+
+
 @pytest.fixture(params=[True, False])
-def test_table(request, db):
+def test_table(request, db, update_chunk_size):
     filtered = db.add_table(FilteredTable(db.db.metadata, "filter", db.db.osmdata.node,
                                           sa.literal_column("tags ? 'include'"),
                                           view_only=request.param))